@@ -4,11 +4,30 @@ from typing import List, Dict, Any
 from datetime import datetime
 from telegram import Message, InlineKeyboardButton, InlineKeyboardMarkup
 
-from shared import db, redis_client, BroadcastModel, BroadcastContent, InlineButton
+from shared import db, redis_client, BroadcastContent, InlineButton
 from .utils import generate_broadcast_id
 
 logger = logging.getLogger(__name__)
 
+# Media content types in priority order, with their file_id getters
+_MEDIA = (
+    ("photo", lambda m: m.photo[-1].file_id),
+    ("video", lambda m: m.video.file_id),
+    ("audio", lambda m: m.audio.file_id),
+    ("document", lambda m: m.document.file_id),
+)
+
+
+def _parse_buttons(message: Message) -> List[List[InlineButton]]:
+    """Extract URL buttons from a message's inline keyboard"""
+    if not (message.reply_markup and message.reply_markup.inline_keyboard):
+        return []
+    rows = (
+        [InlineButton(text=button.text, url=button.url) for button in row if button.url]
+        for row in message.reply_markup.inline_keyboard
+    )
+    return [row for row in rows if row]
+
 
 class BroadcastManager:
     """Manage broadcast operations"""
@@ -16,48 +35,21 @@ class BroadcastManager:
     @staticmethod
     def parse_message_content(message: Message) -> BroadcastContent:
         """Parse message into broadcast content"""
-        content_type = "text"
-        text = None
-        file_id = None
-        caption = None
-        buttons = []
+        buttons = _parse_buttons(message)
         
         # Determine content type
-        if message.photo:
-            content_type = "photo"
-            file_id = message.photo[-1].file_id
-            caption = message.caption
-        elif message.video:
-            content_type = "video"
-            file_id = message.video.file_id
-            caption = message.caption
-        elif message.audio:
-            content_type = "audio"
-            file_id = message.audio.file_id
-            caption = message.caption
-        elif message.document:
-            content_type = "document"
-            file_id = message.document.file_id
-            caption = message.caption
-        elif message.text:
-            content_type = "text"
-            text = message.text
-        
-        # Parse inline buttons
-        if message.reply_markup and message.reply_markup.inline_keyboard:
-            for row in message.reply_markup.inline_keyboard:
-                button_row = []
-                for button in row:
-                    if button.url:
-                        button_row.append(InlineButton(text=button.text, url=button.url))
-                if button_row:
-                    buttons.append(button_row)
+        for content_type, get_file_id in _MEDIA:
+            if getattr(message, content_type):
+                return BroadcastContent(
+                    content_type=content_type,
+                    file_id=get_file_id(message),
+                    caption=message.caption,
+                    buttons=buttons
+                )
         
         return BroadcastContent(
-            content_type=content_type,
-            text=text,
-            file_id=file_id,
-            caption=caption,
+            content_type="text",
+            text=message.text,
             buttons=buttons
         )
     
@@ -66,20 +58,24 @@ class BroadcastManager:
         """Create a new broadcast"""
         broadcast_id = generate_broadcast_id()
         
-        # Count total users
-        total_users = 0
-        for bot_id in bot_ids:
-            count = await db.count_users_by_bot(bot_id)
-            total_users += count
+        # Count total users (single aggregation)
+        counts = await db.count_users_by_bots(bot_ids)
+        total_users = sum(counts.values())
         
-        # Create broadcast document
-        broadcast_data = BroadcastModel(
-            broadcast_id=broadcast_id,
-            bot_ids=bot_ids,
-            content=content,
-            total_users=total_users,
-            started_at=datetime.utcnow()
-        ).model_dump()
+        # Create broadcast document (same shape as BroadcastModel, built directly)
+        now = datetime.utcnow()
+        broadcast_data = {
+            "broadcast_id": broadcast_id,
+            "bot_ids": bot_ids,
+            "content": content.model_dump(),
+            "status": "running",
+            "total_users": total_users,
+            "sent_count": 0,
+            "failed_count": 0,
+            "created_at": now,
+            "started_at": now,
+            "completed_at": None
+        }
         
         # Save to database
         await db.insert_broadcast(broadcast_data)
@@ -94,11 +90,11 @@ class BroadcastManager:
     @staticmethod
     async def get_broadcast_stats(broadcast_id: str) -> Dict[str, Any]:
         """Get broadcast statistics"""
-        # Get from Redis
-        redis_stats = await redis_client.get_broadcast_stats(broadcast_id)
-        
-        # Get from MongoDB
-        broadcast = await db.get_broadcast(broadcast_id)
+        # Get live counters from Redis and the broadcast doc from MongoDB concurrently
+        redis_stats, broadcast = await asyncio.gather(
+            redis_client.get_broadcast_stats(broadcast_id),
+            db.get_broadcast(broadcast_id)
+        )
         
         if not broadcast:
             return None
@@ -116,24 +112,30 @@ class BroadcastManager:
     @staticmethod
     async def pause_broadcast(broadcast_id: str) -> bool:
         """Pause a running broadcast"""
-        await redis_client.set_broadcast_status(broadcast_id, "paused")
-        await db.update_broadcast_status(broadcast_id, "paused")
+        await asyncio.gather(
+            redis_client.set_broadcast_status(broadcast_id, "paused"),
+            db.update_broadcast_status(broadcast_id, "paused")
+        )
         logger.info(f"Paused broadcast {broadcast_id}")
         return True
     
     @staticmethod
     async def resume_broadcast(broadcast_id: str) -> bool:
         """Resume a paused broadcast"""
-        await redis_client.set_broadcast_status(broadcast_id, "running")
-        await db.update_broadcast_status(broadcast_id, "running")
+        await asyncio.gather(
+            redis_client.set_broadcast_status(broadcast_id, "running"),
+            db.update_broadcast_status(broadcast_id, "running")
+        )
         logger.info(f"Resumed broadcast {broadcast_id}")
         return True
     
     @staticmethod
     async def cancel_broadcast(broadcast_id: str) -> bool:
         """Cancel a broadcast"""
-        await redis_client.set_broadcast_status(broadcast_id, "completed")
-        await db.update_broadcast_status(broadcast_id, "completed")
+        await asyncio.gather(
+            redis_client.set_broadcast_status(broadcast_id, "completed"),
+            db.update_broadcast_status(broadcast_id, "completed")
+        )
         logger.info(f"Cancelled broadcast {broadcast_id}")
         return True
 
@@ -1,40 +1,42 @@
 """Broadcast and Health Check Handlers"""
 
+import asyncio
 import logging
+from typing import Dict, Optional, Tuple
 from telegram import Update
+from telegram.error import NetworkError, RetryAfter, TelegramError
 from telegram.ext import ContextTypes, ConversationHandler
 
 from shared import db, Crypto
+from shared.bot_cache import get_all_bots_cached
+from shared.bot_factory import make_bot
 from .broadcast import broadcast_manager
-from .handlers import is_admin, user_data_store
 
 logger = logging.getLogger(__name__)
 
 WAITING_BROADCAST_MESSAGE = 20
 
+# Max concurrent getMe probes during a health check
+HEALTH_CHECK_CONCURRENCY = 50
+
 
 async def broadcast_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Start broadcast"""
-    if not is_admin(update.effective_user.id):
-        await update.message.reply_text("⛔ Unauthorized")
-        return ConversationHandler.END
-    
-    bots = await db.get_all_bots()
+    bots = await get_all_bots_cached()
     alive_bots = [b for b in bots if b["status"] == "alive"]
     
     if not alive_bots:
         await update.message.reply_text("❌ No active bots available for broadcast.")
         return ConversationHandler.END
     
-    # Count total users
-    total_users = 0
-    for bot in alive_bots:
-        count = await db.count_users_by_bot(bot["bot_id"])
-        total_users += count
-    
     # Store bot IDs
     bot_ids = [b["bot_id"] for b in alive_bots]
-    user_data_store[update.effective_user.id] = {"bot_ids": bot_ids}
+    
+    # Count total users (single aggregation)
+    counts = await db.count_users_by_bots(bot_ids)
+    total_users = sum(counts.values())
+    
+    context.user_data["broadcast"] = {"bot_ids": bot_ids}
     
     await update.message.reply_text(
         f"📢 *Start Broadcast*\n\n"
@@ -45,22 +47,19 @@ async def broadcast_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         f"• Text message\n"
         f"• Photo/Video/Audio/Document with caption\n"
         f"• You can add inline buttons\n\n"
-        f"*Variables:* `{{user_name}}`, `{{user_id}}`, `{{bot_name}}`",
-        parse_mode="Markdown"
+        f"*Variables:* `{{user_name}}`, `{{user_id}}`, `{{bot_name}}`"
     )
     return WAITING_BROADCAST_MESSAGE
 
 
 async def receive_broadcast_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Receive broadcast message"""
-    user_id = update.effective_user.id
+    data = context.user_data.pop("broadcast", None)
     
-    if user_id not in user_data_store:
+    if not data:
         await update.message.reply_text("❌ Session expired. Please start over with /broadcast")
         return ConversationHandler.END
     
-    data = user_data_store[user_id]
-    
     # Parse message content
     content = broadcast_manager.parse_message_content(update.message)
     
@@ -72,45 +71,65 @@ async def receive_broadcast_message(update: Update, context: ContextTypes.DEFAUL
         f"Broadcast ID: `{broadcast_id}`\n"
         f"Bots: {len(data['bot_ids'])}\n\n"
         f"Workers will start processing shortly.\n\n"
-        f"Use /broadcaststats `{broadcast_id}` to check progress.",
-        parse_mode="Markdown"
+        f"Use /broadcaststats `{broadcast_id}` to check progress."
     )
     
-    # Cleanup
-    del user_data_store[user_id]
-    
     return ConversationHandler.END
 
 
+def _decrypt_tokens(bots: list) -> Dict[str, Optional[str]]:
+    """Decrypt all bot tokens (CPU-bound, run in a thread), None if undecryptable"""
+    plain = Crypto().decrypt_many([bot.get("token") for bot in bots])
+    return {bot["bot_id"]: token for bot, token in zip(bots, plain)}
+
+
+async def _probe(bot_id: str, token: Optional[str], sem: asyncio.Semaphore) -> Tuple[str, Optional[str]]:
+    """Check a single bot token, returns (bot_id, status), status None if inconclusive"""
+    if token is None:
+        # Not a Telegram verdict (e.g. wrong ENCRYPTION_KEY) - keep the current status
+        logger.error(f"Could not decrypt token for {bot_id}, skipping health probe")
+        return bot_id, None
+    
+    async with sem:
+        try:
+            test_bot = make_bot(token)
+            await test_bot.get_me()
+            return bot_id, "alive"
+        except (NetworkError, RetryAfter) as e:
+            # Transient (includes TimedOut) - keep the current status
+            logger.warning(f"Transient health probe failure for {bot_id}: {e}")
+            return bot_id, None
+        except TelegramError:
+            # InvalidToken, Forbidden, ... - the token is unusable
+            return bot_id, "dead"
+        except Exception as e:
+            logger.error(f"Unexpected health probe error for {bot_id}: {e}")
+            return bot_id, None
+
+
 async def health_check(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Manual health check"""
-    if not is_admin(update.effective_user.id):
-        await update.message.reply_text("⛔ Unauthorized")
-        return
-    
     await update.message.reply_text("🔄 Starting health check...")
     
     bots = await db.get_all_bots()
-    crypto = Crypto()
+    sem = asyncio.Semaphore(HEALTH_CHECK_CONCURRENCY)
     
-    results = {"alive": 0, "dead": 0}
+    # Key derivation and decryption off the event loop, in one batch
+    tokens = await asyncio.to_thread(_decrypt_tokens, bots)
     
-    for bot in bots:
-        try:
-            from telegram import Bot
-            token = crypto.decrypt(bot["token"])
-            test_bot = Bot(token)
-            await test_bot.get_me()
-            
-            await db.update_bot_status(bot["bot_id"], "alive")
-            results["alive"] += 1
-        except:
-            await db.update_bot_status(bot["bot_id"], "dead")
-            results["dead"] += 1
+    # Probe all bots concurrently (bounded by semaphore)
+    checks = await asyncio.gather(*[_probe(bot_id, token, sem) for bot_id, token in tokens.items()])
+    statuses = {bot_id: status for bot_id, status in checks if status}
+
+    # Write all statuses in one round-trip
+    await db.update_bots_status(statuses)
+
+    alive = sum(1 for status in statuses.values() if status == "alive")
+    results = {"alive": alive, "dead": len(statuses) - alive, "skipped": len(checks) - len(statuses)}
     
     await update.message.reply_text(
         f"✅ *Health Check Completed!*\n\n"
         f"✅ Alive: {results['alive']}\n"
-        f"❌ Dead: {results['dead']}",
-        parse_mode="Markdown"
+        f"❌ Dead: {results['dead']}"
+        + (f"\n⚠️ Unchanged (inconclusive): {results['skipped']}" if results['skipped'] else "")
     )
\ No newline at end of file
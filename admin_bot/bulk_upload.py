@@ -1,25 +1,41 @@
 """Bulk Bot Upload Handler"""
 
+import io
+import itertools
 import logging
+import re
 import asyncio
-from telegram import Update
+import time
+from datetime import datetime
+from telegram import Message, Update
+from telegram.error import RetryAfter, TelegramError
 from telegram.ext import ContextTypes, ConversationHandler
 
-from shared import db, Crypto, BotModel
-from .handlers import is_admin, user_data_store
+from shared import db, Crypto
+from shared.bot_factory import make_bot
 from .utils import generate_bot_id, generate_secret_token
 
 logger = logging.getLogger(__name__)
 
 WAITING_BULK_FILE, WAITING_BULK_WORKER = range(100, 102)
 
+# One `token` or `token,worker` entry per line; any other non-comment line lands in group 3
+_TOKEN_LINE = re.compile(
+    rb"^[ \t]*(?:([^,#\s]+)(?:[ \t]*,[ \t]*([^,\s]+))?|([^#\s][^\r\n]*?))[ \t]*\r?$", re.M
+)
+
+# Number of concurrent getMe consumers during bulk upload
+BULK_VALIDATE_CONCURRENCY = 20
+
+# MongoDB duplicate key error code (unique bot_username index)
+DUPLICATE_KEY_ERROR = 11000
+
+# Min seconds between progress message edits (Telegram limits edits per chat)
+PROGRESS_EDIT_INTERVAL = 2.0
+
 
 async def bulk_upload_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Start bulk upload process"""
-    if not is_admin(update.effective_user.id):
-        await update.message.reply_text("⛔ Unauthorized")
-        return ConversationHandler.END
-    
     await update.message.reply_text(
         "📁 *Bulk Bot Upload*\n\n"
         "Upload a `.txt` file with bot tokens.\n\n"
@@ -35,8 +51,7 @@ async def bulk_upload_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "789012:XYZ...,worker-2\n"
         "345678:QRS...,worker-1\n"
         "```\n\n"
-        "Send the file now:",
-        parse_mode="Markdown"
+        "Send the file now:"
     )
     
     return WAITING_BULK_FILE
@@ -44,8 +59,6 @@ async def bulk_upload_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def receive_bulk_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Receive and process bulk file"""
-    user_id = update.effective_user.id
-    
     if not update.message.document:
         await update.message.reply_text(
             "❌ Please send a `.txt` file!\n\n"
@@ -66,45 +79,34 @@ async def receive_bulk_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Download file
     try:
         file = await context.bot.get_file(document.file_id)
-        file_content = await file.download_as_bytearray()
-        content = file_content.decode('utf-8')
-        
-        # Parse tokens
-        lines = [line.strip() for line in content.split('\n') if line.strip()]
+        buf = io.BytesIO()
+        await file.download_to_memory(buf)
         
-        if not lines:
-            await update.message.reply_text("❌ File is empty!")
-            return ConversationHandler.END
-        
-        # Parse tokens and workers
+        # Parse tokens and workers in one regex pass; blank and comment lines don't match
         tokens_data = []
+        malformed = []
         has_workers = False
         
-        for line_num, line in enumerate(lines, 1):
-            # Skip comments
-            if line.startswith('#'):
-                continue
-            
-            # Check if format is token,worker
-            if ',' in line:
-                parts = line.split(',')
-                if len(parts) == 2:
-                    token = parts[0].strip()
-                    worker = parts[1].strip()
-                    tokens_data.append({'token': token, 'worker': worker})
-                    has_workers = True
-                else:
-                    tokens_data.append({'token': line, 'worker': None})
+        for match in _TOKEN_LINE.finditer(buf.getvalue()):
+            token, worker, bad_line = match.group(1, 2, 3)
+            if bad_line:
+                malformed.append(bad_line.decode('utf-8', 'replace'))
+            elif worker:
+                tokens_data.append({'token': token.decode('utf-8'), 'worker': worker.decode('utf-8')})
+                has_workers = True
             else:
-                tokens_data.append({'token': line, 'worker': None})
+                tokens_data.append({'token': token.decode('utf-8'), 'worker': None})
         
         if not tokens_data:
-            await update.message.reply_text("❌ No valid tokens found!")
+            await update.message.reply_text(
+                f"❌ No valid tokens found! ({len(malformed)} malformed lines)" if malformed
+                else "❌ No valid tokens found!"
+            )
             return ConversationHandler.END
         
-        # Store data
-        user_data_store[user_id] = {
+        data = {
             'tokens_data': tokens_data,
+            'malformed': malformed,
             'has_workers': has_workers
         }
         
@@ -113,22 +115,22 @@ async def receive_bulk_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text(
                 f"📊 *File Processed*\n\n"
                 f"Found: {len(tokens_data)} tokens with workers\n\n"
-                f"Starting validation...",
-                parse_mode="Markdown"
+                f"Starting validation..."
             )
             
             # Process immediately
-            await process_bulk_tokens(update, context, user_id)
+            await process_bulk_tokens(update, context, data)
             return ConversationHandler.END
         else:
+            context.user_data['bulk'] = data
+            
             # Ask for default worker
             await update.message.reply_text(
                 f"📊 *File Processed*\n\n"
                 f"Found: {len(tokens_data)} tokens\n\n"
                 f"Which worker should handle these bots?\n"
                 f"(e.g., `worker-1`, `worker-2`)\n\n"
-                f"You can also use round-robin by sending `auto`",
-                parse_mode="Markdown"
+                f"You can also use round-robin by sending `auto`"
             )
             return WAITING_BULK_WORKER
     
@@ -136,40 +138,38 @@ async def receive_bulk_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
         logger.error(f"Error processing file: {e}")
         await update.message.reply_text(
             f"❌ Error processing file: {str(e)}\n\n"
-            "Make sure file is UTF-8 encoded."
+            "Make sure file is UTF-8 encoded.",
+            parse_mode=None
         )
         return ConversationHandler.END
 
 
 async def receive_bulk_worker(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Receive worker assignment for bulk upload"""
-    user_id = update.effective_user.id
+    data = context.user_data.pop('bulk', None)
     
-    if user_id not in user_data_store:
+    if not data:
         await update.message.reply_text("❌ Session expired. Start over with /bulkupload")
         return ConversationHandler.END
     
     worker_input = update.message.text.strip().lower()
     
-    data = user_data_store[user_id]
     tokens_data = data['tokens_data']
     
     # If auto, distribute across workers
     if worker_input == 'auto':
         # Get existing workers
-        bots = await db.get_all_bots()
-        workers = list(set(b['assigned_worker'] for b in bots)) if bots else ['worker-1']
+        workers = await db.get_worker_names() or ['worker-1']
         
         # Round-robin assignment
-        for idx, token_data in enumerate(tokens_data):
+        for token_data, worker in zip(tokens_data, itertools.cycle(workers)):
             if not token_data['worker']:
-                token_data['worker'] = workers[idx % len(workers)]
+                token_data['worker'] = worker
         
         await update.message.reply_text(
             f"🔄 *Auto Distribution*\n\n"
             f"Distributing across {len(workers)} workers...\n\n"
-            f"Starting validation...",
-            parse_mode="Markdown"
+            f"Starting validation..."
         )
     else:
         # Assign all to specified worker
@@ -179,32 +179,58 @@ async def receive_bulk_worker(update: Update, context: ContextTypes.DEFAULT_TYPE
         
         await update.message.reply_text(
             f"⚙️ *Worker: {worker_input}*\n\n"
-            f"Starting validation...",
-            parse_mode="Markdown"
+            f"Starting validation..."
         )
     
     # Process tokens
-    await process_bulk_tokens(update, context, user_id)
+    await process_bulk_tokens(update, context, data)
     
     return ConversationHandler.END
 
 
-async def process_bulk_tokens(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: int):
+async def _validate_consumer(queue: asyncio.Queue, out: asyncio.Queue, resume: asyncio.Event):
+    """Validate queued tokens via getMe, pushing (token_data, bot_info, error) to out"""
+    while True:
+        token_data = await queue.get()
+        await resume.wait()
+        try:
+            test_bot = make_bot(token_data['token'])
+            bot_info = await test_bot.get_me()
+        except RetryAfter as e:
+            # Halt every consumer until flood control lifts, then retry this token
+            if resume.is_set():
+                resume.clear()
+                asyncio.get_running_loop().call_later(e.retry_after, resume.set)
+            queue.put_nowait(token_data)
+            continue
+        except Exception as e:
+            out.put_nowait((token_data, None, str(e)))
+            continue
+        out.put_nowait((token_data, bot_info, None))
+
+
+async def _edit_progress(message: Message, text: str):
+    """Edit a progress message, waiting out flood control if hit"""
+    try:
+        await message.edit_text(text)
+    except RetryAfter as e:
+        await asyncio.sleep(e.retry_after)
+    except TelegramError as e:
+        logger.debug(f"Progress edit failed: {e}")
+
+
+async def process_bulk_tokens(update: Update, context: ContextTypes.DEFAULT_TYPE, data: dict):
     """Process and validate bulk tokens"""
-    
-    if user_id not in user_data_store:
-        return
-    
-    data = user_data_store[user_id]
     tokens_data = data['tokens_data']
     
-    from telegram import Bot
-    
     crypto = Crypto()
     
     results = {
         'success': [],
-        'failed': [],
+        'failed': [
+            {'token': line[:20] + '...', 'reason': 'Malformed line'}
+            for line in data.get('malformed', [])
+        ],
         'duplicate': []
     }
     
@@ -215,122 +241,153 @@ async def process_bulk_tokens(update: Update, context: ContextTypes.DEFAULT_TYPE
         f"⏳ Processing 0/{total} tokens..."
     )
     
-    for idx, token_data in enumerate(tokens_data, 1):
-        token = token_data['token']
-        worker = token_data['worker']
-        
-        try:
-            # Validate token
-            test_bot = Bot(token)
-            bot_info = await test_bot.get_me()
-            bot_username = bot_info.username
-            
-            # Check if already exists
-            existing = await db.db.bots.find_one({"bot_username": bot_username})
-            if existing:
-                results['duplicate'].append({
-                    'username': bot_username,
-                    'reason': 'Already exists'
-                })
-                continue
-            
-            # Encrypt token
-            encrypted_token = crypto.encrypt(token)
-            
-            # Create bot entry
-            bot_id = generate_bot_id()
-            secret_token = generate_secret_token()
-            
-            bot_data = BotModel(
-                bot_id=bot_id,
-                bot_username=bot_username,
-                token=encrypted_token,
-                secret_token=secret_token,
-                assigned_worker=worker,
-                use_global_reply=True
-            ).model_dump()
-            
-            # Save to database
-            success = await db.insert_bot(bot_data)
-            
-            if success:
-                results['success'].append({
-                    'username': bot_username,
-                    'worker': worker,
-                    'bot_id': bot_id
-                })
-            else:
+    # Phase 1: validate tokens with a pool of queue consumers
+    queue = asyncio.Queue()
+    for token_data in tokens_data:
+        queue.put_nowait(token_data)
+    
+    out = asyncio.Queue()
+    resume = asyncio.Event()
+    resume.set()
+    consumers = [
+        asyncio.create_task(_validate_consumer(queue, out, resume))
+        for _ in range(min(BULK_VALIDATE_CONCURRENCY, total))
+    ]
+    
+    validated = []
+    last_edit = 0.0
+    edit_task = None
+    try:
+        for idx in range(1, total + 1):
+            token_data, bot_info, error = await out.get()
+            if error:
                 results['failed'].append({
-                    'token': token[:20] + '...',
-                    'reason': 'Database insert failed'
+                    'token': token_data['token'][:20] + '...',
+                    'reason': error
                 })
+            else:
+                validated.append((token_data, bot_info.username))
             
-            # Update progress every 5 bots or at end
-            if idx % 5 == 0 or idx == total:
-                await progress_msg.edit_text(
-                    f"⏳ Processing {idx}/{total} tokens...\n"
-                    f"✅ Success: {len(results['success'])}\n"
-                    f"❌ Failed: {len(results['failed'])}\n"
-                    f"⚠️ Duplicate: {len(results['duplicate'])}"
-                )
-            
-            # Small delay to avoid rate limits
-            await asyncio.sleep(0.5)
-            
-        except Exception as e:
+            # Update progress in the background at most every PROGRESS_EDIT_INTERVAL
+            # seconds or at end, skipping while the previous edit is still in flight
+            now = time.monotonic()
+            if (now - last_edit >= PROGRESS_EDIT_INTERVAL or idx == total) and (edit_task is None or edit_task.done()):
+                edit_task = asyncio.create_task(_edit_progress(
+                    progress_msg,
+                    f"⏳ Validating {idx}/{total} tokens...\n"
+                    f"✅ Valid: {len(validated)}\n"
+                    f"❌ Failed: {len(results['failed'])}"
+                ))
+                last_edit = now
+    finally:
+        for consumer in consumers:
+            consumer.cancel()
+    
+    # Phase 2: one duplicate lookup for all validated usernames
+    seen = await db.get_existing_bot_usernames([username for _, username in validated])
+    
+    # Phase 3: build new bot documents
+    created_at = datetime.utcnow()
+    to_insert = []
+    pending = []
+    for token_data, bot_username in validated:
+        if bot_username in seen:
+            results['duplicate'].append({
+                'username': bot_username,
+                'reason': 'Already exists'
+            })
+            continue
+        seen.add(bot_username)
+        
+        # Create bot entry (same shape as BotModel, built directly)
+        bot_data = {
+            'bot_id': generate_bot_id(),
+            'bot_username': bot_username,
+            'token': crypto.encrypt(token_data['token']),
+            'secret_token': generate_secret_token(),
+            'assigned_worker': token_data['worker'],
+            'status': 'alive',
+            'auto_reply': None,
+            'use_global_reply': True,
+            'use_worker_reply': True,
+            'created_at': created_at,
+            'last_health_check': None
+        }
+        to_insert.append(bot_data)
+        pending.append(token_data)
+    
+    # Phase 4: save all new bots in one round-trip
+    insert_errors = await db.insert_bots_many(to_insert)
+    
+    for idx, (bot_data, token_data) in enumerate(zip(to_insert, pending)):
+        error = insert_errors.get(idx)
+        if error and error['code'] == DUPLICATE_KEY_ERROR:
+            # Lost a race with another upload - the unique index caught it
+            results['duplicate'].append({
+                'username': bot_data['bot_username'],
+                'reason': 'Already exists'
+            })
+        elif error:
             results['failed'].append({
-                'token': token[:20] + '...',
-                'reason': str(e)
+                'token': token_data['token'][:20] + '...',
+                'reason': error['errmsg']
+            })
+        else:
+            results['success'].append({
+                'username': bot_data['bot_username'],
+                'worker': bot_data['assigned_worker'],
+                'bot_id': bot_data['bot_id']
             })
     
     # Final summary
-    summary = (
+    parts = [
         f"✅ *Bulk Upload Complete!*\n\n"
         f"📊 **Summary:**\n"
-        f"├ Total Processed: {total}\n"
+        f"├ Total Processed: {total + len(data.get('malformed', []))}\n"
         f"├ ✅ Success: {len(results['success'])}\n"
         f"├ ❌ Failed: {len(results['failed'])}\n"
         f"└ ⚠️ Duplicate: {len(results['duplicate'])}\n\n"
-    )
+    ]
     
     # Success details
     if results['success']:
-        summary += f"**✅ Successfully Added ({len(results['success'])}):**\n"
-        for bot in results['success'][:10]:  # Show first 10
-            summary += f"├ @{bot['username']} → {bot['worker']}\n"
+        parts.append(f"**✅ Successfully Added ({len(results['success'])}):**\n")
+        parts.extend(  # Show first 10
+            f"├ @{bot['username']} → {bot['worker']}\n" for bot in results['success'][:10]
+        )
         if len(results['success']) > 10:
-            summary += f"└ ... and {len(results['success']) - 10} more\n"
-        summary += "\n"
+            parts.append(f"└ ... and {len(results['success']) - 10} more\n")
+        parts.append("\n")
     
     # Failed details
     if results['failed']:
-        summary += f"**❌ Failed ({len(results['failed'])}):**\n"
-        for fail in results['failed'][:5]:  # Show first 5
-            summary += f"├ {fail['token']}\n"
-            summary += f"│  Reason: {fail['reason']}\n"
+        parts.append(f"**❌ Failed ({len(results['failed'])}):**\n")
+        parts.extend(  # Show first 5
+            f"├ {fail['token']}\n│  Reason: {fail['reason']}\n" for fail in results['failed'][:5]
+        )
         if len(results['failed']) > 5:
-            summary += f"└ ... and {len(results['failed']) - 5} more\n"
-        summary += "\n"
+            parts.append(f"└ ... and {len(results['failed']) - 5} more\n")
+        parts.append("\n")
     
     # Duplicate details
     if results['duplicate']:
-        summary += f"**⚠️ Duplicate ({len(results['duplicate'])}):**\n"
-        for dup in results['duplicate'][:5]:  # Show first 5
-            summary += f"├ @{dup['username']}\n"
+        parts.append(f"**⚠️ Duplicate ({len(results['duplicate'])}):**\n")
+        parts.extend(  # Show first 5
+            f"├ @{dup['username']}\n" for dup in results['duplicate'][:5]
+        )
         if len(results['duplicate']) > 5:
-            summary += f"└ ... and {len(results['duplicate']) - 5} more\n"
+            parts.append(f"└ ... and {len(results['duplicate']) - 5} more\n")
     
-    await progress_msg.edit_text(summary, parse_mode="Markdown")
+    # Don't let a late progress edit overwrite the summary
+    if edit_task and not edit_task.done():
+        edit_task.cancel()
     
-    # Cleanup
-    del user_data_store[user_id]
+    await progress_msg.edit_text("".join(parts))
 
 
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Cancel bulk upload"""
-    user_id = update.effective_user.id
-    if user_id in user_data_store:
-        del user_data_store[user_id]
+    context.user_data.pop('bulk', None)
     
     await update.message.reply_text("❌ Bulk upload cancelled.")
     return ConversationHandler.END
\ No newline at end of file
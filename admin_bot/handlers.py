@@ -2,12 +2,15 @@ import logging
 import asyncio
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import ContextTypes, ConversationHandler, CallbackQueryHandler
+from pymongo.errors import DuplicateKeyError
 
-from shared import db, Crypto, BotModel, BotStatus
+from shared import db, redis_client, Crypto, BotModel, BotStatus
+from shared.bot_cache import get_all_bots_cached
+from shared.bot_factory import make_bot
 from shared.reply_manager import reply_manager
 from .utils import (
     is_admin, generate_bot_id, generate_secret_token,
-    format_bot_stats
+    format_bot_stats, build_toggle_rows
 )
 from .broadcast import broadcast_manager
 
@@ -19,53 +22,49 @@ logger = logging.getLogger(__name__)
  WAITING_TEMPLATE_DESC, WAITING_TEMPLATE_CONTENT, WAITING_REPLY_MODE,
  WAITING_MULTI_SELECT, WAITING_WORKER_SELECT) = range(12)
 
-# Store temporary data
-user_data_store = {}
+_UNAUTHORIZED = "⛔ Unauthorized"
+
+_START_TEXT = (
+    "🤖 *Bot Farm Admin Panel v2.0*\n\n"
+    "📋 *Bot Management:*\n"
+    "/addbot - Add a single bot\n"
+    "/bulkupload - Upload .txt file with multiple tokens\n"
+    "/listbots - List all bots\n"
+    "/stats - Show system statistics\n"
+    "/health - Check bot health\n\n"
+    "💬 *Reply Management:*\n"
+    "/setreply - Set auto-reply (ALL/Multiple/Single)\n"
+    "/viewreply - View current replies\n\n"
+    "📁 *Templates:*\n"
+    "/createtemplate - Create reply template\n"
+    "/templates - View all templates\n"
+    "/usetemplate - Apply template to bots\n\n"
+    "📢 *Broadcasting:*\n"
+    "/broadcast - Start a broadcast\n\n"
+    "/help - Show this message"
+)
 
 
 # ==================== BASIC COMMANDS ====================
 
+async def unauthorized(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Reply to commands from non-admins"""
+    await update.message.reply_text(_UNAUTHORIZED)
+
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle /start command"""
-    if not is_admin(update.effective_user.id):
-        await update.message.reply_text("⛔ Unauthorized")
-        return
-    
-    text = (
-        "🤖 *Bot Farm Admin Panel v2.0*\n\n"
-        "📋 *Bot Management:*\n"
-        "/addbot - Add a single bot\n"
-        "/bulkupload - Upload .txt file with multiple tokens\n"
-        "/listbots - List all bots\n"
-        "/stats - Show system statistics\n"
-        "/health - Check bot health\n\n"
-        "💬 *Reply Management:*\n"
-        "/setreply - Set auto-reply (ALL/Multiple/Single)\n"
-        "/viewreply - View current replies\n\n"
-        "📁 *Templates:*\n"
-        "/createtemplate - Create reply template\n"
-        "/templates - View all templates\n"
-        "/usetemplate - Apply template to bots\n\n"
-        "📢 *Broadcasting:*\n"
-        "/broadcast - Start a broadcast\n\n"
-        "/help - Show this message"
-    )
-    await update.message.reply_text(text, parse_mode="Markdown")
+    await update.message.reply_text(_START_TEXT)
 
 
 # ==================== ADD BOT ====================
 
 async def add_bot_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Start add bot conversation"""
-    if not is_admin(update.effective_user.id):
-        await update.message.reply_text("⛔ Unauthorized")
-        return ConversationHandler.END
-    
     await update.message.reply_text(
         "🤖 *Add New Bot*\n\n"
         "Please send me the bot token:\n"
-        "Format: `123456:ABC-DEF...`",
-        parse_mode="Markdown"
+        "Format: `123456:ABC-DEF...`"
     )
     return WAITING_TOKEN
 
@@ -79,30 +78,20 @@ async def receive_token(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return WAITING_TOKEN
     
     try:
-        from telegram import Bot
-        test_bot = Bot(token)
+        test_bot = make_bot(token)
         bot_info = await test_bot.get_me()
         
-        # Check if already exists
-        existing = await db.db.bots.find_one({"bot_username": bot_info.username})
-        if existing:
-            await update.message.reply_text(
-                f"⚠️ Bot @{bot_info.username} already exists!\n\n"
-                f"Try another token or /cancel"
-            )
-            return WAITING_TOKEN
-        
-        user_data_store[update.effective_user.id] = {
+        context.user_data.clear()
+        context.user_data.update({
             "token": token,
             "username": bot_info.username
-        }
+        })
         
         await update.message.reply_text(
             f"✅ Token verified!\n"
             f"Bot: @{bot_info.username}\n\n"
             f"Which worker should handle this bot?\n"
-            f"(e.g., `worker-1`, `worker-2`)",
-            parse_mode="Markdown"
+            f"(e.g., `worker-1`, `worker-2`)"
         )
         return WAITING_WORKER
         
@@ -110,7 +99,8 @@ async def receive_token(update: Update, context: ContextTypes.DEFAULT_TYPE):
         logger.error(f"Token validation error: {e}")
         await update.message.reply_text(
             f"❌ Token validation failed: {str(e)}\n\n"
-            f"Please try again or /cancel"
+            f"Please try again or /cancel",
+            parse_mode=None
         )
         return WAITING_TOKEN
 
@@ -118,13 +108,12 @@ async def receive_token(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def receive_worker(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Receive worker assignment"""
     worker_name = update.message.text.strip()
-    user_id = update.effective_user.id
+    data = context.user_data
     
-    if user_id not in user_data_store:
+    if "token" not in data:
         await update.message.reply_text("❌ Session expired. Please start over with /addbot")
         return ConversationHandler.END
     
-    data = user_data_store[user_id]
     crypto = Crypto()
     encrypted_token = crypto.encrypt(data["token"])
     
@@ -140,7 +129,17 @@ async def receive_worker(update: Update, context: ContextTypes.DEFAULT_TYPE):
         use_global_reply=True
     ).model_dump()
     
-    success = await db.insert_bot(bot_data)
+    # Duplicate usernames are rejected by insert_bot
+    try:
+        success = await db.insert_bot(bot_data)
+    except DuplicateKeyError:
+        await update.message.reply_text(
+            f"⚠️ Bot @{data['username']} already exists!\n\n"
+            f"Start over with /addbot to add another token.",
+            parse_mode=None
+        )
+        context.user_data.clear()
+        return ConversationHandler.END
     
     if success:
         await update.message.reply_text(
@@ -149,13 +148,12 @@ async def receive_worker(update: Update, context: ContextTypes.DEFAULT_TYPE):
             f"🆔 Bot ID: `{bot_id}`\n"
             f"⚙️ Worker: {worker_name}\n"
             f"💬 Reply Mode: Global (uses global reply)\n\n"
-            f"The bot will be activated when the worker starts.",
-            parse_mode="Markdown"
+            f"The bot will be activated when the worker starts."
         )
     else:
         await update.message.reply_text("❌ Failed to add bot. Please try again.")
     
-    del user_data_store[user_id]
+    context.user_data.clear()
     return ConversationHandler.END
 
 
@@ -163,20 +161,20 @@ async def receive_worker(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def list_bots(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """List all bots"""
-    if not is_admin(update.effective_user.id):
-        await update.message.reply_text("⛔ Unauthorized")
-        return
-    
-    bots = await db.get_all_bots()
+    # Fetch only the first page (projected) plus the total
+    bots, total_bots = await asyncio.gather(db.list_bots_page(limit=20), db.count_bots())
     
     if not bots:
         await update.message.reply_text("No bots found. Add one with /addbot or /bulkupload")
         return
     
-    text = f"🤖 *Bot List ({len(bots)} bots)*\n\n"
+    parts = [f"🤖 *Bot List ({total_bots} bots)*\n\n"]
+    
+    # One aggregation for the shown bots' user counts
+    counts = await db.count_users_by_bots([bot["bot_id"] for bot in bots])
     
-    for bot in bots[:20]:  # Show first 20
-        user_count = await db.count_users_by_bot(bot["bot_id"])
+    for bot in bots:  # Show first 20
+        user_count = counts.get(bot["bot_id"], 0)
         reply_mode = "Custom"
         if bot.get("use_global_reply"):
             reply_mode = "Global"
@@ -185,47 +183,41 @@ async def list_bots(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
         status_emoji = "✅" if bot['status'] == "alive" else "❌"
         
-        text += f"{status_emoji} @{bot['bot_username']}\n"
-        text += f"├ Status: {bot['status']}\n"
-        text += f"├ Users: {user_count:,}\n"
-        text += f"├ Worker: {bot['assigned_worker']}\n"
-        text += f"└ Reply: {reply_mode}\n\n"
+        parts.append(
+            f"{status_emoji} @{bot['bot_username']}\n"
+            f"├ Status: {bot['status']}\n"
+            f"├ Users: {user_count:,}\n"
+            f"├ Worker: {bot['assigned_worker']}\n"
+            f"└ Reply: {reply_mode}\n\n"
+        )
     
-    if len(bots) > 20:
-        text += f"_... and {len(bots) - 20} more bots_"
+    if total_bots > len(bots):
+        parts.append(f"_... and {total_bots - len(bots)} more bots_")
     
-    await update.message.reply_text(text, parse_mode="Markdown")
+    await update.message.reply_text("".join(parts))
 
 
 # ==================== STATS ====================
 
 async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Show system statistics"""
-    if not is_admin(update.effective_user.id):
-        await update.message.reply_text("⛔ Unauthorized")
-        return
-    
-    bots = await db.get_all_bots()
-    templates = await db.get_all_templates()
+    bot_stats = await db.get_bot_stats()
+    template_count = await db.count_templates()
     
-    total_bots = len(bots)
-    alive_bots = sum(1 for b in bots if b["status"] == "alive")
-    global_reply_bots = sum(1 for b in bots if b.get("use_global_reply", True))
-    worker_reply_bots = sum(1 for b in bots if b.get("use_worker_reply") and not b.get("use_global_reply"))
-    custom_reply_bots = total_bots - global_reply_bots - worker_reply_bots
+    total_bots = bot_stats["total"]
+    alive_bots = bot_stats["by_status"].get("alive", 0)
+    global_reply_bots = bot_stats["global_reply"]
+    worker_reply_bots = bot_stats["worker_reply"]
+    custom_reply_bots = bot_stats["custom_reply"]
     
-    total_users = 0
-    for bot in bots:
-        count = await db.count_users_by_bot(bot["bot_id"])
-        total_users += count
+    # Only count users of bots that still exist
+    counts = await db.count_users_by_bots(await db.get_bot_ids())
+    total_users = sum(counts.values())
     
     # Get worker distribution
-    workers = {}
-    for bot in bots:
-        worker = bot['assigned_worker']
-        workers[worker] = workers.get(worker, 0) + 1
+    workers = bot_stats["by_worker"]
     
-    text = (
+    parts = [
         f"📊 *System Statistics*\n\n"
         f"🤖 *Bots:*\n"
         f"├ Total: {total_bots}\n"
@@ -235,25 +227,20 @@ async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
         f"├ Worker Reply: {worker_reply_bots}\n"
         f"└ Custom Reply: {custom_reply_bots}\n\n"
         f"👥 *Users:* {total_users:,}\n"
-        f"📁 *Templates:* {len(templates)}\n\n"
-    )
+        f"📁 *Templates:* {template_count}\n\n"
+    ]
     
     if workers:
-        text += f"⚙️ *Workers:*\n"
-        for worker, count in sorted(workers.items()):
-            text += f"├ {worker}: {count} bots\n"
+        parts.append("⚙️ *Workers:*\n")
+        parts.extend(f"├ {worker}: {count} bots\n" for worker, count in sorted(workers.items()))
     
-    await update.message.reply_text(text, parse_mode="Markdown")
+    await update.message.reply_text("".join(parts))
 
 
 # ==================== REPLY MANAGEMENT ====================
 
 async def set_reply_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Start setting reply - Choose mode"""
-    if not is_admin(update.effective_user.id):
-        await update.message.reply_text("⛔ Unauthorized")
-        return ConversationHandler.END
-    
     keyboard = [
         [InlineKeyboardButton("🌐 ALL Bots", callback_data="reply_mode_all")],
         [InlineKeyboardButton("✅ Select Multiple Bots", callback_data="reply_mode_multi")],
@@ -264,8 +251,7 @@ async def set_reply_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(
         "💬 *Set Auto-Reply*\n\n"
         "Choose how you want to set the reply:",
-        reply_markup=InlineKeyboardMarkup(keyboard),
-        parse_mode="Markdown"
+        reply_markup=InlineKeyboardMarkup(keyboard)
     )
     
     return WAITING_REPLY_MODE
@@ -277,9 +263,9 @@ async def receive_reply_mode(update: Update, context: ContextTypes.DEFAULT_TYPE)
     await query.answer()
     
     mode = query.data.replace("reply_mode_", "")
-    user_id = query.from_user.id
     
-    user_data_store[user_id] = {"mode": mode}
+    context.user_data.clear()
+    context.user_data["mode"] = mode
     
     if mode == "all":
         await query.edit_message_text(
@@ -293,15 +279,13 @@ async def receive_reply_mode(update: Update, context: ContextTypes.DEFAULT_TYPE)
             "`{user_name}` - User's first name\n"
             "`{user_id}` - User's ID\n"
             "`{bot_name}` - Bot's name\n"
-            "`{bot_username}` - Bot's username",
-            parse_mode="Markdown"
+            "`{bot_username}` - Bot's username"
         )
         return WAITING_REPLY_MESSAGE
     
     elif mode == "worker":
         # Get unique workers
-        bots = await db.get_all_bots()
-        workers = sorted(list(set(b["assigned_worker"] for b in bots)))
+        workers = await db.get_worker_names()
         
         if not workers:
             await query.edit_message_text("❌ No workers found. Add bots first!")
@@ -312,39 +296,36 @@ async def receive_reply_mode(update: Update, context: ContextTypes.DEFAULT_TYPE)
         await query.edit_message_text(
             "⚙️ *Select Worker*\n\n"
             "Choose which worker's bots should get this reply:",
-            reply_markup=InlineKeyboardMarkup(keyboard),
-            parse_mode="Markdown"
+            reply_markup=InlineKeyboardMarkup(keyboard)
         )
         return WAITING_WORKER_SELECT
     
     elif mode == "multi":
-        bots = await db.get_all_bots()
+        bots = await get_all_bots_cached()
         if not bots:
             await query.edit_message_text("❌ No bots found. Add bots first!")
             return ConversationHandler.END
         
         # Show bot selection with pagination
-        keyboard = []
-        for bot in bots[:10]:  # Show first 10
-            keyboard.append([InlineKeyboardButton(
-                f"☐ @{bot['bot_username']}", 
-                callback_data=f"togglebot_{bot['bot_id']}"
-            )])
+        page_bots = [(bot["bot_id"], bot["bot_username"]) for bot in bots[:10]]  # Show first 10
+        keyboard = build_toggle_rows(page_bots, frozenset(), "togglebot_")
         keyboard.append([InlineKeyboardButton("✅ Done Selecting", callback_data="multi_done")])
         
-        user_data_store[user_id]["selected_bots"] = []
+        context.user_data["selected_bots"] = set()
+        context.user_data["page_bots"] = page_bots
+        context.user_data["keyboard"] = keyboard
+        context.user_data["row_by_bot"] = {bot_id: i for i, (bot_id, _) in enumerate(page_bots)}
         
         await query.edit_message_text(
             "✅ *Select Multiple Bots*\n\n"
             "Tap bots to select/deselect:\n"
             "(Showing first 10 bots)",
-            reply_markup=InlineKeyboardMarkup(keyboard),
-            parse_mode="Markdown"
+            reply_markup=InlineKeyboardMarkup(keyboard)
         )
         return WAITING_MULTI_SELECT
     
     else:  # single
-        bots = await db.get_all_bots()
+        bots = await get_all_bots_cached()
         if not bots:
             await query.edit_message_text("❌ No bots found. Add bots first!")
             return ConversationHandler.END
@@ -357,8 +338,7 @@ async def receive_reply_mode(update: Update, context: ContextTypes.DEFAULT_TYPE)
         await query.edit_message_text(
             "🎯 *Select Bot*\n\n"
             "Choose which bot to set reply for:",
-            reply_markup=InlineKeyboardMarkup(keyboard),
-            parse_mode="Markdown"
+            reply_markup=InlineKeyboardMarkup(keyboard)
         )
         return WAITING_BOT_SELECT
 
@@ -369,9 +349,8 @@ async def receive_worker_selection(update: Update, context: ContextTypes.DEFAULT
     await query.answer()
     
     worker_name = query.data.replace("worker_", "")
-    user_id = query.from_user.id
     
-    user_data_store[user_id]["worker"] = worker_name
+    context.user_data["worker"] = worker_name
     
     await query.edit_message_text(
         f"⚙️ *Setting Reply for Worker: {worker_name}*\n\n"
@@ -379,8 +358,7 @@ async def receive_worker_selection(update: Update, context: ContextTypes.DEFAULT
         f"• Plain text\n"
         f"• Text with buttons: `[Button Text](https://url.com)`\n"
         f"• Photo/Video with caption\n\n"
-        f"*Variables:* `{{user_name}}`, `{{user_id}}`, `{{bot_name}}`",
-        parse_mode="Markdown"
+        f"*Variables:* `{{user_name}}`, `{{user_id}}`, `{{bot_name}}`"
     )
     
     return WAITING_REPLY_MESSAGE
@@ -389,53 +367,52 @@ async def receive_worker_selection(update: Update, context: ContextTypes.DEFAULT
 async def toggle_bot_selection(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Toggle bot selection in multi-select mode"""
     query = update.callback_query
-    user_id = query.from_user.id
     
     if query.data == "multi_done":
         await query.answer()
         
-        if user_id not in user_data_store or not user_data_store[user_id].get("selected_bots"):
+        if not context.user_data.get("selected_bots"):
             await query.answer("❌ Please select at least one bot!", show_alert=True)
             return WAITING_MULTI_SELECT
         
-        count = len(user_data_store[user_id]["selected_bots"])
+        count = len(context.user_data["selected_bots"])
         await query.edit_message_text(
             f"✅ *{count} Bots Selected*\n\n"
             f"Now send me the reply message:\n"
             f"• Plain text\n"
             f"• Text with buttons: `[Button Text](https://url.com)`\n"
             f"• Photo/Video with caption\n\n"
-            f"*Variables:* `{{user_name}}`, `{{user_id}}`, `{{bot_name}}`",
-            parse_mode="Markdown"
+            f"*Variables:* `{{user_name}}`, `{{user_id}}`, `{{bot_name}}`"
         )
         return WAITING_REPLY_MESSAGE
     
     bot_id = query.data.replace("togglebot_", "")
     
-    if user_id not in user_data_store:
-        user_data_store[user_id] = {"selected_bots": []}
-    
-    selected = user_data_store[user_id].get("selected_bots", [])
+    selected = context.user_data.setdefault("selected_bots", set())
+    page_bots = context.user_data.get("page_bots")
     
     if bot_id in selected:
-        selected.remove(bot_id)
+        selected.discard(bot_id)
         await query.answer("❌ Deselected")
     else:
-        selected.append(bot_id)
+        selected.add(bot_id)
         await query.answer("✅ Selected")
     
-    user_data_store[user_id]["selected_bots"] = selected
+    keyboard = context.user_data.get("keyboard")
+    row = context.user_data.get("row_by_bot", {}).get(bot_id)
+    done_row = [InlineKeyboardButton(f"✅ Done ({len(selected)} selected)", callback_data="multi_done")]
     
-    # Update keyboard
-    bots = await db.get_all_bots()
-    keyboard = []
-    for bot in bots[:10]:
-        check = "☑" if bot["bot_id"] in selected else "☐"
-        keyboard.append([InlineKeyboardButton(
-            f"{check} @{bot['bot_username']}", 
-            callback_data=f"togglebot_{bot['bot_id']}"
-        )])
-    keyboard.append([InlineKeyboardButton(f"✅ Done ({len(selected)} selected)", callback_data="multi_done")])
+    if keyboard is not None and row is not None:
+        # Only the toggled row and the Done button change
+        keyboard[row] = build_toggle_rows([page_bots[row]], selected, "togglebot_")[0]
+        keyboard[-1] = done_row
+    else:
+        # Rebuild from the page captured at selection start
+        if page_bots is None:
+            bots = await get_all_bots_cached()
+            page_bots = [(bot["bot_id"], bot["bot_username"]) for bot in bots[:10]]
+            context.user_data["page_bots"] = page_bots
+        keyboard = build_toggle_rows(page_bots, selected, "togglebot_") + [done_row]
     
     await query.edit_message_reply_markup(InlineKeyboardMarkup(keyboard))
     
@@ -448,14 +425,13 @@ async def receive_single_bot_selection(update: Update, context: ContextTypes.DEF
     await query.answer()
     
     bot_id = query.data.replace("singlebot_", "")
-    user_id = query.from_user.id
     
     bot_data = await db.get_bot(bot_id)
     if not bot_data:
         await query.edit_message_text("❌ Bot not found!")
         return ConversationHandler.END
     
-    user_data_store[user_id]["bot_id"] = bot_id
+    context.user_data["bot_id"] = bot_id
     
     await query.edit_message_text(
         f"🎯 *Setting Reply for @{bot_data['bot_username']}*\n\n"
@@ -463,8 +439,7 @@ async def receive_single_bot_selection(update: Update, context: ContextTypes.DEF
         f"• Plain text\n"
         f"• Text with buttons: `[Button Text](https://url.com)`\n"
         f"• Photo/Video with caption\n\n"
-        f"*Variables:* `{{user_name}}`, `{{user_id}}`, `{{bot_name}}`",
-        parse_mode="Markdown"
+        f"*Variables:* `{{user_name}}`, `{{user_id}}`, `{{bot_name}}`"
     )
     
     return WAITING_REPLY_MESSAGE
@@ -472,13 +447,12 @@ async def receive_single_bot_selection(update: Update, context: ContextTypes.DEF
 
 async def receive_reply_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Receive and save reply message"""
-    user_id = update.effective_user.id
+    data = context.user_data
     
-    if user_id not in user_data_store:
+    if "mode" not in data:
         await update.message.reply_text("❌ Session expired. Start over with /setreply")
         return ConversationHandler.END
     
-    data = user_data_store[user_id]
     mode = data.get("mode")
     
     # Parse message
@@ -507,13 +481,13 @@ async def receive_reply_message(update: Update, context: ContextTypes.DEFAULT_TY
             await update.message.reply_text(
                 "✅ *Global Reply Set!*\n\n"
                 "All bots will now use this reply (unless they have custom/worker reply).\n\n"
-                "*Preview:*",
-                parse_mode="Markdown"
+                "*Preview:*"
             )
             
             await update.message.reply_text(
                 reply_content.get("text", "Hello!"),
-                reply_markup=preview_keyboard
+                reply_markup=preview_keyboard,
+                parse_mode=None
             )
         else:
             await update.message.reply_text("❌ Failed to set global reply.")
@@ -530,18 +504,16 @@ async def receive_reply_message(update: Update, context: ContextTypes.DEFAULT_TY
         if success:
             await update.message.reply_text(
                 f"✅ *Worker Reply Set!*\n\n"
-                f"All bots in `{worker_name}` will use this reply.",
-                parse_mode="Markdown"
+                f"All bots in `{worker_name}` will use this reply."
             )
     
     elif mode == "multi":
-        selected_bots = data.get("selected_bots", [])
+        selected_bots = list(data.get("selected_bots", ()))
         count = await db.update_bots_reply(selected_bots, reply_content)
         
         await update.message.reply_text(
             f"✅ *Reply Set for {count} Bots!*\n\n"
-            f"Selected bots will now use this custom reply.",
-            parse_mode="Markdown"
+            f"Selected bots will now use this custom reply."
         )
     
     else:  # single
@@ -550,55 +522,55 @@ async def receive_reply_message(update: Update, context: ContextTypes.DEFAULT_TY
             {"bot_id": bot_id},
             {"$set": {"auto_reply": reply_content, "use_global_reply": False, "use_worker_reply": False}}
         )
+        await db.publish_bots_changed(bot_id)
         
         if result.modified_count > 0:
             await update.message.reply_text(
                 "✅ *Reply Set!*\n\n"
-                "Bot will now use this custom reply.",
-                parse_mode="Markdown"
+                "Bot will now use this custom reply."
             )
     
-    del user_data_store[user_id]
+    context.user_data.clear()
     return ConversationHandler.END
 
 
 async def view_reply(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """View current auto-reply settings"""
-    if not is_admin(update.effective_user.id):
-        await update.message.reply_text("⛔ Unauthorized")
-        return
-    
     # Show global reply
     global_reply = await db.get_global_reply()
     
-    text = "💬 *Reply Configuration*\n\n"
+    parts = ["💬 *Reply Configuration*\n\n"]
     
     if global_reply and global_reply.get("enabled"):
         content = global_reply.get("content", {})
-        text += f"🌐 *Global Reply:* ✅ Enabled\n"
-        text += f"Text: {content.get('text', 'N/A')[:50]}...\n\n"
+        parts.append(
+            f"🌐 *Global Reply:* ✅ Enabled\n"
+            f"Text: {content.get('text', 'N/A')[:50]}...\n\n"
+        )
     else:
-        text += f"🌐 *Global Reply:* ❌ Not set\n\n"
+        parts.append("🌐 *Global Reply:* ❌ Not set\n\n")
     
     # Show sample of bot replies
-    bots = await db.get_all_bots()
-    if bots:
-        global_count = sum(1 for b in bots if b.get("use_global_reply", True))
-        worker_count = sum(1 for b in bots if b.get("use_worker_reply") and not b.get("use_global_reply"))
-        custom_count = len(bots) - global_count - worker_count
+    bot_stats = await db.get_bot_stats()
+    if bot_stats["total"]:
+        global_count = bot_stats["global_reply"]
+        worker_count = bot_stats["worker_reply"]
+        custom_count = bot_stats["custom_reply"]
         
-        text += f"📊 *Bot Distribution:*\n"
-        text += f"├ Using Global: {global_count}\n"
-        text += f"├ Using Worker: {worker_count}\n"
-        text += f"└ Custom Reply: {custom_count}\n"
+        parts.append(
+            f"📊 *Bot Distribution:*\n"
+            f"├ Using Global: {global_count}\n"
+            f"├ Using Worker: {worker_count}\n"
+            f"└ Custom Reply: {custom_count}\n"
+        )
     
-    await update.message.reply_text(text, parse_mode="Markdown")
+    await update.message.reply_text("".join(parts))
 
 
 async def global_reply_shortcut(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Quick set global reply"""
     if not is_admin(update.effective_user.id):
-        await update.message.reply_text("⛔ Unauthorized")
+        await update.message.reply_text(_UNAUTHORIZED)
         return
     
     await update.message.reply_text(
@@ -608,15 +580,14 @@ async def global_reply_shortcut(update: Update, context: ContextTypes.DEFAULT_TY
         "• Plain text\n"
         "• Text with buttons: `[Button](https://url.com)`\n"
         "• Photo/Video with caption\n\n"
-        "*Variables:* `{user_name}`, `{user_id}`, `{bot_name}`",
-        parse_mode="Markdown"
+        "*Variables:* `{user_name}`, `{user_id}`, `{bot_name}`"
     )
 
 
 async def delete_reply(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Delete bot reply - choose mode"""
     if not is_admin(update.effective_user.id):
-        await update.message.reply_text("⛔ Unauthorized")
+        await update.message.reply_text(_UNAUTHORIZED)
         return
     
     keyboard = [
@@ -626,8 +597,7 @@ async def delete_reply(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     await update.message.reply_text(
         "🗑️ *Delete Reply*\n\nChoose what to delete:",
-        reply_markup=InlineKeyboardMarkup(keyboard),
-        parse_mode="Markdown"
+        reply_markup=InlineKeyboardMarkup(keyboard)
     )
 
 
@@ -637,11 +607,11 @@ async def handle_delete_reply(update: Update, context: ContextTypes.DEFAULT_TYPE
     await query.answer()
     
     if query.data == "del_global":
-        await db.db.global_replies.delete_one({"reply_id": "global_default"})
+        await db.delete_global_reply()
         await query.edit_message_text("✅ Global reply deleted!")
     
     elif query.data == "del_bot":
-        bots = await db.get_all_bots()
+        bots = await get_all_bots_cached()
         if not bots:
             await query.edit_message_text("❌ No bots found")
             return
@@ -657,6 +627,7 @@ async def handle_delete_bot_reply(update: Update, context: ContextTypes.DEFAULT_
     
     bot_id = query.data.replace("delbot_", "")
     await db.db.bots.update_one({"bot_id": bot_id}, {"$set": {"auto_reply": None, "use_global_reply": True}})
+    await db.publish_bots_changed(bot_id)
     await query.edit_message_text("✅ Bot reply deleted! Now using global reply.")
 
 
@@ -664,9 +635,8 @@ async def handle_delete_bot_reply(update: Update, context: ContextTypes.DEFAULT_
 
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Cancel conversation"""
-    user_id = update.effective_user.id
-    if user_id in user_data_store:
-        del user_data_store[user_id]
+    context.user_data.clear()
+    await redis_client.delete_session(update.effective_user.id)
     
     await update.message.reply_text("❌ Operation cancelled.")
     return ConversationHandler.END
@@ -1,12 +1,16 @@
 """Template Management Handlers"""
 
+import asyncio
 import logging
+import re
+import uuid
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import ContextTypes, ConversationHandler
 
-from shared import db
+from shared import db, redis_client
+from shared.bot_cache import get_all_bots_cached
 from shared.reply_manager import reply_manager
-from .handlers import is_admin, user_data_store
+from .utils import build_toggle_rows
 
 logger = logging.getLogger(__name__)
 
@@ -14,13 +18,39 @@ logger = logging.getLogger(__name__)
 WAITING_TEMPLATE_NAME, WAITING_TEMPLATE_DESC, WAITING_TEMPLATE_CONTENT = range(10, 13)
 WAITING_TEMPLATE_SELECT, WAITING_TEMPLATE_MODE = range(13, 15)
 
+# Redis cache for the template list
+TEMPLATES_CACHE_KEY = "templates:all"
+TEMPLATES_CACHE_TTL = 10
+# Per-template entries offered by /usetemplate, read back on selection
+TEMPLATE_SELECT_TTL = 300
+
+# HTML special characters for parse_mode="HTML" messages
+_HTML_ESCAPE_TABLE = str.maketrans({'&': '&amp;', '<': '&lt;', '>': '&gt;'})
+_NEEDS_ESCAPE = re.compile(r'[&<>]').search
+
+
+def _esc(text: str) -> str:
+    """Escape text for HTML messages, returning it untouched if nothing needs escaping"""
+    return text.translate(_HTML_ESCAPE_TABLE) if _NEEDS_ESCAPE(text) else text
+
+
+async def get_templates_cached() -> list:
+    """Get all templates (listing fields only), served from Redis for TEMPLATES_CACHE_TTL seconds"""
+    templates = await redis_client.get_cached(TEMPLATES_CACHE_KEY)
+    if templates is None:
+        templates = await db.get_all_templates_lite()
+        await redis_client.set_cached(TEMPLATES_CACHE_KEY, templates, TEMPLATES_CACHE_TTL)
+    return templates
+
+
+async def _record_template_use(template_id: str):
+    """Bump a template's usage count and drop the cached list"""
+    await db.increment_template_usage(template_id)
+    await redis_client.invalidate_cached(TEMPLATES_CACHE_KEY)
+
 
 async def create_template_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Start creating a template"""
-    if not is_admin(update.effective_user.id):
-        await update.message.reply_text("⛔ Unauthorized")
-        return ConversationHandler.END
-    
     await update.message.reply_text(
         "📁 <b>Create Reply Template</b>\n\n"
         "Step 1: Give your template a name\n"
@@ -36,10 +66,10 @@ async def receive_template_name(update: Update, context: ContextTypes.DEFAULT_TY
     template_name = update.message.text.strip()
     user_id = update.effective_user.id
     
-    user_data_store[user_id] = {"template_name": template_name}
+    await redis_client.start_session(user_id, {"template_name": template_name})
     
     await update.message.reply_text(
-        f"✅ Template name: <b>{template_name}</b>\n\n"
+        f"✅ Template name: <b>{_esc(template_name)}</b>\n\n"
         f"Step 2: Send a short description (optional)\n"
         f"Or send <code>/skip</code> to skip",
         parse_mode="HTML"
@@ -52,7 +82,7 @@ async def receive_template_desc(update: Update, context: ContextTypes.DEFAULT_TY
     """Receive template description"""
     user_id = update.effective_user.id
     
-    if user_id not in user_data_store:
+    if await redis_client.get_session(user_id) is None:
         await update.message.reply_text("❌ Session expired.")
         return ConversationHandler.END
     
@@ -61,7 +91,7 @@ async def receive_template_desc(update: Update, context: ContextTypes.DEFAULT_TY
     else:
         description = update.message.text.strip()
     
-    user_data_store[user_id]["template_desc"] = description
+    await redis_client.update_session(user_id, {"template_desc": description})
     
     await update.message.reply_text(
         "📝 <b>Step 3: Send the template content</b>\n\n"
@@ -80,17 +110,15 @@ async def receive_template_content(update: Update, context: ContextTypes.DEFAULT
     """Receive and save template content"""
     user_id = update.effective_user.id
     
-    if user_id not in user_data_store:
+    data = await redis_client.get_session(user_id)
+    if data is None:
         await update.message.reply_text("❌ Session expired.")
         return ConversationHandler.END
     
-    data = user_data_store[user_id]
-    
     # Parse message
     reply_content = reply_manager.parse_message_to_reply(update.message)
     
     # Create template
-    import uuid
     template_id = f"tpl_{uuid.uuid4().hex[:12]}"
     
     template_data = {
@@ -98,10 +126,15 @@ async def receive_template_content(update: Update, context: ContextTypes.DEFAULT
         "name": data["template_name"],
         "description": data.get("template_desc"),
         "content": reply_content,
-        "usage_count": 0
+        "usage_count": 0,
+        # Pre-escaped display fields for list_templates
+        "name_html": _esc(data["template_name"]),
+        "desc_html": _esc(data.get("template_desc") or ""),
+        "preview_html": _esc(reply_content.get("text", "")[:40])
     }
     
     success = await db.insert_template(template_data)
+    await redis_client.invalidate_cached(TEMPLATES_CACHE_KEY)
     
     if success:
         # Show preview
@@ -109,15 +142,14 @@ async def receive_template_content(update: Update, context: ContextTypes.DEFAULT
         keyboard = None
         
         if reply_content.get("buttons"):
-            keyboard_buttons = []
-            for row in reply_content["buttons"]:
-                button_row = [InlineKeyboardButton(text=btn["text"], url=btn["url"]) for btn in row]
-                keyboard_buttons.append(button_row)
-            keyboard = InlineKeyboardMarkup(keyboard_buttons)
+            keyboard = InlineKeyboardMarkup([
+                [InlineKeyboardButton(text=btn["text"], url=btn["url"]) for btn in row]
+                for row in reply_content["buttons"]
+            ])
         
         # Escape HTML special characters in text preview
-        text_preview = text[:100].replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
-        template_name_escaped = data['template_name'].replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+        text_preview = _esc(text[:100])
+        template_name_escaped = _esc(data['template_name'])
         
         await update.message.reply_text(
             f"✅ <b>Template Created!</b>\n\n"
@@ -130,17 +162,13 @@ async def receive_template_content(update: Update, context: ContextTypes.DEFAULT
     else:
         await update.message.reply_text("❌ Failed to create template.")
     
-    del user_data_store[user_id]
+    await redis_client.delete_session(user_id)
     return ConversationHandler.END
 
 
 async def list_templates(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """List all templates"""
-    if not is_admin(update.effective_user.id):
-        await update.message.reply_text("⛔ Unauthorized")
-        return
-    
-    templates = await db.get_all_templates()
+    templates = await get_templates_cached()
     
     if not templates:
         await update.message.reply_text(
@@ -149,32 +177,31 @@ async def list_templates(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
     
-    text = f"📁 <b>Templates ({len(templates)})</b>\n\n"
+    parts = [f"📁 <b>Templates ({len(templates)})</b>\n\n"]
     
     for tpl in templates:
-        content = tpl.get("content", {})
-        # Escape HTML in template name
-        name = tpl['name'].replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
-        text += f"<b>{name}</b>\n"
-        text += f"├ ID: <code>{tpl['template_id']}</code>\n"
-        text += f"├ Used: {tpl.get('usage_count', 0)} times\n"
+        # Stored pre-escaped at creation; escape on the fly for older templates
+        name = tpl.get("name_html") or _esc(tpl['name'])
+        parts.append(
+            f"<b>{name}</b>\n"
+            f"├ ID: <code>{tpl['template_id']}</code>\n"
+            f"├ Used: {tpl.get('usage_count', 0)} times\n"
+        )
         
         if tpl.get("description"):
-            desc = tpl['description'].replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
-            text += f"├ Desc: {desc}\n"
+            parts.append(f"├ Desc: {tpl.get('desc_html') or _esc(tpl['description'])}\n")
         
-        preview = content.get("text", "")[:40].replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
-        text += f"└ Preview: {preview}...\n\n"
+        preview = tpl.get("preview_html")
+        if preview is None:
+            preview = _esc(tpl["preview"])
+        parts.append(f"└ Preview: {preview}...\n\n")
     
-    await update.message.reply_text(text, parse_mode="HTML")
+    await update.message.reply_text("".join(parts), parse_mode="HTML")
 
 
 async def use_template_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Start using a template"""
-    if not is_admin(update.effective_user.id):
-        await update.message.reply_text("⛔ Unauthorized")
-        return ConversationHandler.END
-    
+    # Full documents: the selection below is served from these
     templates = await db.get_all_templates()
     
     if not templates:
@@ -184,12 +211,16 @@ async def use_template_start(update: Update, context: ContextTypes.DEFAULT_TYPE)
         )
         return ConversationHandler.END
     
-    keyboard = []
-    for tpl in templates:
-        keyboard.append([InlineKeyboardButton(
-            tpl['name'],
-            callback_data=f"usetpl_{tpl['template_id']}"
-        )])
+    # Keep the offered templates around so the selection skips MongoDB
+    await redis_client.set_cached_many(
+        {f"template:{tpl['template_id']}": tpl for tpl in templates},
+        TEMPLATE_SELECT_TTL
+    )
+    
+    keyboard = [[InlineKeyboardButton(
+        tpl['name'],
+        callback_data=f"usetpl_{tpl['template_id']}"
+    )] for tpl in templates]
     
     await update.message.reply_text(
         "📁 <b>Select Template</b>\n\n"
@@ -209,12 +240,12 @@ async def receive_template_selection(update: Update, context: ContextTypes.DEFAU
     template_id = query.data.replace("usetpl_", "")
     user_id = query.from_user.id
     
-    template = await db.get_template(template_id)
+    template = await redis_client.get_cached(f"template:{template_id}") or await db.get_template(template_id)
     if not template:
         await query.edit_message_text("❌ Template not found!")
         return ConversationHandler.END
     
-    user_data_store[user_id] = {"template": template}
+    await redis_client.start_session(user_id, {"template": template})
     
     keyboard = [
         [InlineKeyboardButton("🌐 ALL Bots", callback_data="tpl_mode_all")],
@@ -223,7 +254,7 @@ async def receive_template_selection(update: Update, context: ContextTypes.DEFAU
     ]
     
     # Escape HTML in template name
-    name = template['name'].replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+    name = _esc(template['name'])
     
     await query.edit_message_text(
         f"📁 <b>Template: {name}</b>\n\n"
@@ -243,21 +274,20 @@ async def receive_template_mode(update: Update, context: ContextTypes.DEFAULT_TY
     mode = query.data.replace("tpl_mode_", "")
     user_id = query.from_user.id
     
-    if user_id not in user_data_store:
+    session = await redis_client.get_session(user_id)
+    if session is None:
         await query.edit_message_text("❌ Session expired.")
         return ConversationHandler.END
     
-    template = user_data_store[user_id]["template"]
+    template = session["template"]
     content = template["content"]
     
     if mode == "all":
-        # Apply to all bots
-        bots = await db.get_all_bots()
-        bot_ids = [b["bot_id"] for b in bots]
-        count = await db.update_bots_reply(bot_ids, content)
-        
-        # Update usage count
-        await db.increment_template_usage(template["template_id"])
+        # Apply to all bots (single update_many, no id list) and update usage count
+        count, _ = await asyncio.gather(
+            db.update_all_bots_reply(content),
+            _record_template_use(template["template_id"])
+        )
         
         await query.edit_message_text(
             f"✅ <b>Template Applied!</b>\n\n"
@@ -265,22 +295,17 @@ async def receive_template_mode(update: Update, context: ContextTypes.DEFAULT_TY
             parse_mode="HTML"
         )
         
-        del user_data_store[user_id]
+        await redis_client.delete_session(user_id)
         return ConversationHandler.END
     
     elif mode == "multi":
         # Show bot selection
-        bots = await db.get_all_bots()
-        keyboard = []
-        for bot in bots[:10]:
-            keyboard.append([InlineKeyboardButton(
-                f"☐ @{bot['bot_username']}", 
-                callback_data=f"tpltoggle_{bot['bot_id']}"
-            )])
+        bots = await get_all_bots_cached()
+        page_bots = [(bot["bot_id"], bot["bot_username"]) for bot in bots[:10]]
+        keyboard = build_toggle_rows(page_bots, frozenset(), "tpltoggle_")
         keyboard.append([InlineKeyboardButton("✅ Apply", callback_data="tpl_apply")])
         
-        user_data_store[user_id]["selected_bots"] = []
-        user_data_store[user_id]["mode"] = "multi"
+        await redis_client.update_session(user_id, {"selected_bots": [], "page_bots": page_bots, "mode": "multi"})
         
         await query.edit_message_text(
             "✅ <b>Select Bots</b>\n\n"
@@ -292,13 +317,13 @@ async def receive_template_mode(update: Update, context: ContextTypes.DEFAULT_TY
         return WAITING_TEMPLATE_MODE
     
     else:  # single
-        bots = await db.get_all_bots()
+        bots = await get_all_bots_cached()
         keyboard = [[InlineKeyboardButton(
             f"@{bot['bot_username']}", 
             callback_data=f"tplsingle_{bot['bot_id']}"
         )] for bot in bots[:15]]
         
-        user_data_store[user_id]["mode"] = "single"
+        await redis_client.update_session(user_id, {"mode": "single"})
         
         await query.edit_message_text(
             "🎯 <b>Select Bot</b>",
@@ -314,52 +339,57 @@ async def handle_template_bot_action(update: Update, context: ContextTypes.DEFAU
     query = update.callback_query
     user_id = query.from_user.id
     
-    if user_id not in user_data_store:
-        await query.answer("❌ Session expired!", show_alert=True)
-        return ConversationHandler.END
-    
-    template = user_data_store[user_id]["template"]
-    content = template["content"]
-    
-    # Handle toggle
+    # Handle toggle (reads only the selection fields, not the template)
     if query.data.startswith("tpltoggle_"):
+        session = await redis_client.get_session(user_id, "selected_bots", "page_bots")
+        if session is None:
+            await query.answer("❌ Session expired!", show_alert=True)
+            return ConversationHandler.END
+        
         bot_id = query.data.replace("tpltoggle_", "")
-        selected = user_data_store[user_id].get("selected_bots", [])
+        selected = set(session.get("selected_bots", ()))
         
         if bot_id in selected:
-            selected.remove(bot_id)
-            await query.answer("❌ Deselected")
+            selected.discard(bot_id)
+            answer = "❌ Deselected"
         else:
-            selected.append(bot_id)
-            await query.answer("✅ Selected")
+            selected.add(bot_id)
+            answer = "✅ Selected"
         
-        user_data_store[user_id]["selected_bots"] = selected
+        # Stored as a JSON list
+        await asyncio.gather(
+            query.answer(answer),
+            redis_client.update_session(user_id, {"selected_bots": list(selected)})
+        )
         
-        # Update keyboard
-        bots = await db.get_all_bots()
-        keyboard = []
-        for bot in bots[:10]:
-            check = "☑" if bot["bot_id"] in selected else "☐"
-            keyboard.append([InlineKeyboardButton(
-                f"{check} @{bot['bot_username']}", 
-                callback_data=f"tpltoggle_{bot['bot_id']}"
-            )])
+        # Update keyboard from the page captured when selection started
+        keyboard = build_toggle_rows(session.get("page_bots", []), selected, "tpltoggle_")
         keyboard.append([InlineKeyboardButton(f"✅ Apply ({len(selected)})", callback_data="tpl_apply")])
         
         await query.edit_message_reply_markup(InlineKeyboardMarkup(keyboard))
         return WAITING_TEMPLATE_MODE
     
+    session = await redis_client.get_session(user_id)
+    if session is None:
+        await query.answer("❌ Session expired!", show_alert=True)
+        return ConversationHandler.END
+    
+    template = session["template"]
+    content = template["content"]
+    
     # Handle apply
-    elif query.data == "tpl_apply":
+    if query.data == "tpl_apply":
         await query.answer()
-        selected = user_data_store[user_id].get("selected_bots", [])
+        selected = session.get("selected_bots", [])
         
         if not selected:
             await query.answer("❌ Select at least one bot!", show_alert=True)
             return WAITING_TEMPLATE_MODE
         
-        count = await db.update_bots_reply(selected, content)
-        await db.increment_template_usage(template["template_id"])
+        count, _ = await asyncio.gather(
+            db.update_bots_reply(selected, content),
+            _record_template_use(template["template_id"])
+        )
         
         await query.edit_message_text(
             f"✅ <b>Template Applied!</b>\n\n"
@@ -367,7 +397,7 @@ async def handle_template_bot_action(update: Update, context: ContextTypes.DEFAU
             parse_mode="HTML"
         )
         
-        del user_data_store[user_id]
+        await redis_client.delete_session(user_id)
         return ConversationHandler.END
     
     # Handle single bot
@@ -375,28 +405,31 @@ async def handle_template_bot_action(update: Update, context: ContextTypes.DEFAU
         await query.answer()
         bot_id = query.data.replace("tplsingle_", "")
         
-        result = await db.db.bots.update_one(
-            {"bot_id": bot_id},
-            {"$set": {"auto_reply": content, "use_global_reply": False, "use_worker_reply": False}}
+        result, _ = await asyncio.gather(
+            db.db.bots.update_one(
+                {"bot_id": bot_id},
+                {"$set": {"auto_reply": content, "use_global_reply": False, "use_worker_reply": False}}
+            ),
+            _record_template_use(template["template_id"])
         )
+        await db.publish_bots_changed(bot_id)
         
-        await db.increment_template_usage(template["template_id"])
-        
-        if result.modified_count > 0:
+        # matched, not modified: re-applying identical content is still a success
+        if result.matched_count:
             await query.edit_message_text(
                 "✅ <b>Template Applied!</b>",
                 parse_mode="HTML"
             )
+        else:
+            await query.edit_message_text("❌ Bot not found!")
         
-        del user_data_store[user_id]
+        await redis_client.delete_session(user_id)
         return ConversationHandler.END
 
 
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Cancel conversation"""
-    user_id = update.effective_user.id
-    if user_id in user_data_store:
-        del user_data_store[user_id]
+    await redis_client.delete_session(update.effective_user.id)
     
     await update.message.reply_text("❌ Operation cancelled.")
     return ConversationHandler.END
\ No newline at end of file
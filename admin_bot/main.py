@@ -1,20 +1,29 @@
+import asyncio
 import os
+import re
 import logging
 from dotenv import load_dotenv
+from telegram.constants import ParseMode
 from telegram.ext import (
+    AIORateLimiter,
     Application,
     CommandHandler,
     MessageHandler,
     ConversationHandler,
     CallbackQueryHandler,
+    Defaults,
     filters,
     ContextTypes
 )
 import telegram
+from telegram.request import HTTPXRequest
 
 from shared import db, redis_client
+from shared.bot_factory import close_shared_request
+from .utils import ADMIN_FILTER, load_admin_ids
 from .handlers import (
     start,
+    unauthorized,
     add_bot_start,
     receive_token,
     receive_worker,
@@ -80,6 +89,28 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Message filters shared by the conversation handlers
+_TEXT_INPUT = filters.TEXT & ~filters.COMMAND
+_CONTENT_INPUT = (filters.TEXT | filters.PHOTO | filters.VIDEO) & ~filters.COMMAND
+_REPLY_INPUT = (filters.TEXT | filters.PHOTO | filters.VIDEO | filters.Document.ALL) & ~filters.COMMAND
+_BROADCAST_INPUT = (
+    filters.TEXT | filters.PHOTO | filters.VIDEO | filters.AUDIO | filters.Document.ALL
+) & ~filters.COMMAND
+_DOCUMENT_INPUT = filters.Document.ALL & ~filters.COMMAND
+
+# Callback query patterns, compiled once
+_P_REPLY_MODE = re.compile(r"^reply_mode_")
+_P_WORKER = re.compile(r"^worker_")
+_P_TOGGLEBOT = re.compile(r"^togglebot_")
+_P_MULTI_DONE = re.compile(r"^multi_done$")
+_P_SINGLEBOT = re.compile(r"^singlebot_")
+_P_USETPL = re.compile(r"^usetpl_")
+_P_TPL_MODE = re.compile(r"^tpl_mode_")
+_P_TPLTOGGLE = re.compile(r"^tpltoggle_")
+_P_TPL_APPLY = re.compile(r"^tpl_apply$")
+_P_TPLSINGLE = re.compile(r"^tplsingle_")
+_P_WREPLY = re.compile(r"^wreply_")
+
 
 async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE):
     """Handle errors - prevent crashes on network issues"""
@@ -93,15 +124,19 @@ async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE):
 
 async def post_init(application: Application):
     """Initialize connections after bot starts"""
-    await db.connect()
-    await redis_client.connect()
+    admin_ids = load_admin_ids()
+    if not admin_ids:
+        logger.warning("ADMIN_USER_IDS is empty - every command will be refused")
+    await asyncio.gather(db.connect(), redis_client.connect())
+    # Open a pooled Redis connection before the first update needs one
+    await redis_client.ping()
     logger.info("Admin bot initialized")
 
 
 async def post_shutdown(application: Application):
     """Cleanup connections on shutdown"""
-    await db.disconnect()
-    await redis_client.disconnect()
+    await asyncio.gather(db.disconnect(), redis_client.disconnect())
+    await close_shared_request()
     logger.info("Admin bot shutdown")
 
 
@@ -113,8 +148,6 @@ def main():
         raise ValueError("ADMIN_BOT_TOKEN not set")
     
     # Increase timeouts for network stability
-    from telegram.request import HTTPXRequest
-    
     request = HTTPXRequest(
         connection_pool_size=8,
         connect_timeout=30.0,
@@ -127,6 +160,8 @@ def main():
         Application.builder()
         .token(token)
         .request(request)
+        .rate_limiter(AIORateLimiter(overall_max_rate=30, max_retries=3))
+        .defaults(Defaults(parse_mode=ParseMode.MARKDOWN))
         .post_init(post_init)
         .post_shutdown(post_shutdown)
         .build()
@@ -134,10 +169,10 @@ def main():
     
     # Add bot conversation handler
     add_bot_conv = ConversationHandler(
-        entry_points=[CommandHandler("addbot", add_bot_start)],
+        entry_points=[CommandHandler("addbot", add_bot_start, filters=ADMIN_FILTER)],
         states={
-            WAITING_TOKEN: [MessageHandler(filters.TEXT & ~filters.COMMAND, receive_token)],
-            WAITING_WORKER: [MessageHandler(filters.TEXT & ~filters.COMMAND, receive_worker)],
+            WAITING_TOKEN: [MessageHandler(_TEXT_INPUT, receive_token)],
+            WAITING_WORKER: [MessageHandler(_TEXT_INPUT, receive_worker)],
         },
         fallbacks=[CommandHandler("cancel", cancel)],
         per_message=False
@@ -145,18 +180,18 @@ def main():
     
     # Set reply conversation handler
     set_reply_conv = ConversationHandler(
-        entry_points=[CommandHandler("setreply", set_reply_start)],
+        entry_points=[CommandHandler("setreply", set_reply_start, filters=ADMIN_FILTER)],
         states={
-            WAITING_REPLY_MODE: [CallbackQueryHandler(receive_reply_mode, pattern="^reply_mode_")],
-            WAITING_WORKER_SELECT: [CallbackQueryHandler(receive_worker_selection, pattern="^worker_")],
+            WAITING_REPLY_MODE: [CallbackQueryHandler(receive_reply_mode, pattern=_P_REPLY_MODE)],
+            WAITING_WORKER_SELECT: [CallbackQueryHandler(receive_worker_selection, pattern=_P_WORKER)],
             WAITING_MULTI_SELECT: [
-                CallbackQueryHandler(toggle_bot_selection, pattern="^togglebot_"),
-                CallbackQueryHandler(toggle_bot_selection, pattern="^multi_done$")
+                CallbackQueryHandler(toggle_bot_selection, pattern=_P_TOGGLEBOT),
+                CallbackQueryHandler(toggle_bot_selection, pattern=_P_MULTI_DONE)
             ],
-            WAITING_BOT_SELECT: [CallbackQueryHandler(receive_single_bot_selection, pattern="^singlebot_")],
+            WAITING_BOT_SELECT: [CallbackQueryHandler(receive_single_bot_selection, pattern=_P_SINGLEBOT)],
             WAITING_REPLY_MESSAGE: [
                 MessageHandler(
-                    (filters.TEXT | filters.PHOTO | filters.VIDEO | filters.Document.ALL) & ~filters.COMMAND,
+                    _REPLY_INPUT,
                     receive_reply_message
                 )
             ],
@@ -167,13 +202,13 @@ def main():
     
     # Create template conversation handler
     create_template_conv = ConversationHandler(
-        entry_points=[CommandHandler("createtemplate", create_template_start)],
+        entry_points=[CommandHandler("createtemplate", create_template_start, filters=ADMIN_FILTER)],
         states={
-            WAITING_TEMPLATE_NAME: [MessageHandler(filters.TEXT & ~filters.COMMAND, receive_template_name)],
-            WAITING_TEMPLATE_DESC: [MessageHandler(filters.TEXT & ~filters.COMMAND, receive_template_desc)],
+            WAITING_TEMPLATE_NAME: [MessageHandler(_TEXT_INPUT, receive_template_name)],
+            WAITING_TEMPLATE_DESC: [MessageHandler(_TEXT_INPUT, receive_template_desc)],
             WAITING_TEMPLATE_CONTENT: [
                 MessageHandler(
-                    (filters.TEXT | filters.PHOTO | filters.VIDEO) & ~filters.COMMAND,
+                    _CONTENT_INPUT,
                     receive_template_content
                 )
             ],
@@ -184,14 +219,14 @@ def main():
     
     # Use template conversation handler
     use_template_conv = ConversationHandler(
-        entry_points=[CommandHandler("usetemplate", use_template_start)],
+        entry_points=[CommandHandler("usetemplate", use_template_start, filters=ADMIN_FILTER)],
         states={
-            WAITING_TEMPLATE_SELECT: [CallbackQueryHandler(receive_template_selection, pattern="^usetpl_")],
+            WAITING_TEMPLATE_SELECT: [CallbackQueryHandler(receive_template_selection, pattern=_P_USETPL)],
             WAITING_TEMPLATE_MODE: [
-                CallbackQueryHandler(receive_template_mode, pattern="^tpl_mode_"),
-                CallbackQueryHandler(handle_template_bot_action, pattern="^tpltoggle_"),
-                CallbackQueryHandler(handle_template_bot_action, pattern="^tpl_apply$"),
-                CallbackQueryHandler(handle_template_bot_action, pattern="^tplsingle_")
+                CallbackQueryHandler(receive_template_mode, pattern=_P_TPL_MODE),
+                CallbackQueryHandler(handle_template_bot_action, pattern=_P_TPLTOGGLE),
+                CallbackQueryHandler(handle_template_bot_action, pattern=_P_TPL_APPLY),
+                CallbackQueryHandler(handle_template_bot_action, pattern=_P_TPLSINGLE)
             ],
         },
         fallbacks=[CommandHandler("cancel", cancel)],
@@ -200,12 +235,11 @@ def main():
     
     # Broadcast conversation handler
     broadcast_conv = ConversationHandler(
-        entry_points=[CommandHandler("broadcast", broadcast_start)],
+        entry_points=[CommandHandler("broadcast", broadcast_start, filters=ADMIN_FILTER)],
         states={
             WAITING_BROADCAST_MESSAGE: [
                 MessageHandler(
-                    (filters.TEXT | filters.PHOTO | filters.VIDEO | 
-                     filters.AUDIO | filters.Document.ALL) & ~filters.COMMAND,
+                    _BROADCAST_INPUT,
                     receive_broadcast_message
                 )
             ],
@@ -216,13 +250,13 @@ def main():
     
     # Bulk upload conversation handler
     bulk_upload_conv = ConversationHandler(
-        entry_points=[CommandHandler("bulkupload", bulk_upload_start)],
+        entry_points=[CommandHandler("bulkupload", bulk_upload_start, filters=ADMIN_FILTER)],
         states={
             WAITING_BULK_FILE: [
-                MessageHandler(filters.Document.ALL & ~filters.COMMAND, receive_bulk_file)
+                MessageHandler(_DOCUMENT_INPUT, receive_bulk_file)
             ],
             WAITING_BULK_WORKER: [
-                MessageHandler(filters.TEXT & ~filters.COMMAND, receive_bulk_worker)
+                MessageHandler(_TEXT_INPUT, receive_bulk_worker)
             ],
         },
         fallbacks=[CommandHandler("cancel", cancel)],
@@ -231,11 +265,11 @@ def main():
     
     # Global reply conversation handler
     global_reply_conv = ConversationHandler(
-        entry_points=[CommandHandler("globalreply", global_reply_start)],
+        entry_points=[CommandHandler("globalreply", global_reply_start, filters=ADMIN_FILTER)],
         states={
             WAITING_GLOBAL_MESSAGE: [
                 MessageHandler(
-                    (filters.TEXT | filters.PHOTO | filters.VIDEO) & ~filters.COMMAND,
+                    _CONTENT_INPUT,
                     receive_global_message
                 )
             ],
@@ -246,12 +280,12 @@ def main():
     
     # Worker reply conversation handler
     worker_reply_conv = ConversationHandler(
-        entry_points=[CommandHandler("workerreply", worker_reply_start)],
+        entry_points=[CommandHandler("workerreply", worker_reply_start, filters=ADMIN_FILTER)],
         states={
-            WAITING_WORKER_NAME: [CallbackQueryHandler(receive_worker_name, pattern="^wreply_")],
+            WAITING_WORKER_NAME: [CallbackQueryHandler(receive_worker_name, pattern=_P_WREPLY)],
             WAITING_WORKER_MESSAGE: [
                 MessageHandler(
-                    (filters.TEXT | filters.PHOTO | filters.VIDEO) & ~filters.COMMAND,
+                    _CONTENT_INPUT,
                     receive_worker_message
                 )
             ],
@@ -261,8 +295,8 @@ def main():
     )
     
     # Add all handlers
-    application.add_handler(CommandHandler("start", start))
-    application.add_handler(CommandHandler("help", start))
+    application.add_handler(CommandHandler("start", start, filters=ADMIN_FILTER))
+    application.add_handler(CommandHandler("help", start, filters=ADMIN_FILTER))
     application.add_handler(add_bot_conv)
     application.add_handler(set_reply_conv)
     application.add_handler(create_template_conv)
@@ -271,11 +305,14 @@ def main():
     application.add_handler(bulk_upload_conv)
     application.add_handler(global_reply_conv)
     application.add_handler(worker_reply_conv)
-    application.add_handler(CommandHandler("listbots", list_bots))
-    application.add_handler(CommandHandler("stats", stats))
-    application.add_handler(CommandHandler("health", health_check))
-    application.add_handler(CommandHandler("viewreply", view_reply))
-    application.add_handler(CommandHandler("templates", list_templates))
+    application.add_handler(CommandHandler("listbots", list_bots, filters=ADMIN_FILTER))
+    application.add_handler(CommandHandler("stats", stats, filters=ADMIN_FILTER))
+    application.add_handler(CommandHandler("health", health_check, filters=ADMIN_FILTER))
+    application.add_handler(CommandHandler("viewreply", view_reply, filters=ADMIN_FILTER))
+    application.add_handler(CommandHandler("templates", list_templates, filters=ADMIN_FILTER))
+    
+    # Admin-only commands above are filtered by user id; answer everyone else here
+    application.add_handler(MessageHandler(filters.COMMAND & ~ADMIN_FILTER, unauthorized))
     
     # Add error handler
     application.add_error_handler(error_handler)
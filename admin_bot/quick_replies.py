@@ -1,42 +1,62 @@
 """Quick reply shortcuts - globalreply and workerreply"""
 
 import logging
+from functools import lru_cache
+from typing import Tuple
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.constants import MessageLimit
 from telegram.ext import ContextTypes, ConversationHandler
 
-from shared import db
+from shared import db, redis_client
 from shared.reply_manager import reply_manager
-from .handlers import is_admin, user_data_store
 
 logger = logging.getLogger(__name__)
 
 WAITING_GLOBAL_MESSAGE, WAITING_WORKER_NAME, WAITING_WORKER_MESSAGE = range(200, 203)
 
+_GLOBAL_REPLY_HELP = (
+    "🌐 *Set Global Reply*\n\n"
+    "This will be used by ALL bots (unless they have custom reply).\n\n"
+    "Send your message now:\n"
+    "• Plain text\n"
+    "• Text with buttons: `[Button](https://url.com)`\n"
+    "• Photo/Video with caption\n\n"
+    "*Variables:* `{user_name}`, `{user_id}`, `{bot_name}`\n\n"
+    "Example:\n"
+    "```\n"
+    "Welcome {user_name}! 👋\n\n"
+    "[Visit Website](https://example.com)\n"
+    "[Join Channel](https://t.me/channel)\n"
+    "```"
+)
+
+# Prefixed to the preview so confirmation and preview go out as one message
+_GLOBAL_REPLY_SET = (
+    "✅ Global Reply Set Successfully!\n\n"
+    "All bots will now use this reply.\n\n"
+    "Preview:\n\n"
+)
+
+_WORKER_REPLY_HELP = (
+    "Send your message now:\n"
+    "• Plain text\n"
+    "• Text with buttons: `[Button](https://url.com)`\n"
+    "• Photo/Video with caption\n\n"
+    "*Variables:* `{user_name}`, `{user_id}`, `{bot_name}`"
+)
+
+
+@lru_cache(maxsize=8)
+def _worker_keyboard(workers: Tuple[str, ...]) -> InlineKeyboardMarkup:
+    """Worker picker keyboard, reused while the worker list is unchanged"""
+    return InlineKeyboardMarkup([[InlineKeyboardButton(w, callback_data=f"wreply_{w}")] for w in workers])
+
 
 # ==================== GLOBAL REPLY ====================
 
 async def global_reply_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Start global reply setup"""
-    if not is_admin(update.effective_user.id):
-        await update.message.reply_text("⛔ Unauthorized")
-        return ConversationHandler.END
-    
-    await update.message.reply_text(
-        "🌐 *Set Global Reply*\n\n"
-        "This will be used by ALL bots (unless they have custom reply).\n\n"
-        "Send your message now:\n"
-        "• Plain text\n"
-        "• Text with buttons: `[Button](https://url.com)`\n"
-        "• Photo/Video with caption\n\n"
-        "*Variables:* `{user_name}`, `{user_id}`, `{bot_name}`\n\n"
-        "Example:\n"
-        "```\n"
-        "Welcome {user_name}! 👋\n\n"
-        "[Visit Website](https://example.com)\n"
-        "[Join Channel](https://t.me/channel)\n"
-        "```",
-        parse_mode="Markdown"
-    )
+    await update.message.reply_text(_GLOBAL_REPLY_HELP)
     
     return WAITING_GLOBAL_MESSAGE
 
@@ -45,9 +65,6 @@ async def receive_global_message(update: Update, context: ContextTypes.DEFAULT_T
     """Receive and save global reply"""
     user_id = update.effective_user.id
     
-    if not is_admin(user_id):
-        return ConversationHandler.END
-    
     # Parse message
     reply_content = reply_manager.parse_message_to_reply(update.message)
     
@@ -66,39 +83,37 @@ async def receive_global_message(update: Update, context: ContextTypes.DEFAULT_T
     
     if success:
         # Preview
-        preview_keyboard = None
-        if reply_content.get("buttons"):
-            keyboard_buttons = []
-            for row in reply_content["buttons"]:
-                button_row = [InlineKeyboardButton(text=btn["text"], url=btn["url"]) for btn in row]
-                keyboard_buttons.append(button_row)
-            preview_keyboard = InlineKeyboardMarkup(keyboard_buttons)
+        preview_keyboard = reply_manager.build_keyboard(reply_content.get("buttons"))
+        media_type = reply_content.get("media_type")
+        text = reply_content.get("text") or ""
         
-        await update.message.reply_text(
-            "✅ *Global Reply Set Successfully!*\n\n"
-            "All bots will now use this reply.\n\n"
-            "*Preview:*",
-            parse_mode="Markdown"
-        )
+        limit = MessageLimit.CAPTION_LENGTH if media_type in ("photo", "video") else MessageLimit.MAX_TEXT_LENGTH
+        if len(_GLOBAL_REPLY_SET) + len(text) <= limit:
+            text = _GLOBAL_REPLY_SET + text
+        else:
+            # Too long to prefix - confirm separately
+            await update.message.reply_text(_GLOBAL_REPLY_SET.rstrip(), parse_mode=None)
         
         # Send preview
-        text = reply_content.get("text", "Hello!")
-        if reply_content.get("media_type") == "photo":
+        if media_type == "photo":
             await update.message.reply_photo(
                 photo=reply_content["media_file_id"],
                 caption=text,
-                reply_markup=preview_keyboard
+                reply_markup=preview_keyboard,
+                parse_mode=None
             )
-        elif reply_content.get("media_type") == "video":
+        elif media_type == "video":
             await update.message.reply_video(
                 video=reply_content["media_file_id"],
                 caption=text,
-                reply_markup=preview_keyboard
+                reply_markup=preview_keyboard,
+                parse_mode=None
             )
         else:
             await update.message.reply_text(
                 text,
-                reply_markup=preview_keyboard
+                reply_markup=preview_keyboard,
+                parse_mode=None
             )
     else:
         await update.message.reply_text("❌ Failed to set global reply.")
@@ -110,25 +125,17 @@ async def receive_global_message(update: Update, context: ContextTypes.DEFAULT_T
 
 async def worker_reply_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Start worker reply setup"""
-    if not is_admin(update.effective_user.id):
-        await update.message.reply_text("⛔ Unauthorized")
-        return ConversationHandler.END
-    
     # Get unique workers
-    bots = await db.get_all_bots()
-    workers = sorted(list(set(b["assigned_worker"] for b in bots)))
+    workers = await db.get_worker_names()
     
     if not workers:
         await update.message.reply_text("❌ No workers found. Add bots first!")
         return ConversationHandler.END
     
-    keyboard = [[InlineKeyboardButton(w, callback_data=f"wreply_{w}")] for w in workers]
-    
     await update.message.reply_text(
         "⚙️ *Set Worker Reply*\n\n"
         "Select which worker:",
-        reply_markup=InlineKeyboardMarkup(keyboard),
-        parse_mode="Markdown"
+        reply_markup=_worker_keyboard(tuple(workers))
     )
     
     return WAITING_WORKER_NAME
@@ -142,16 +149,10 @@ async def receive_worker_name(update: Update, context: ContextTypes.DEFAULT_TYPE
     worker_name = query.data.replace("wreply_", "")
     user_id = query.from_user.id
     
-    user_data_store[user_id] = {"worker": worker_name}
+    await redis_client.start_session(user_id, {"worker": worker_name})
     
     await query.edit_message_text(
-        f"⚙️ *Setting Reply for Worker: {worker_name}*\n\n"
-        f"Send your message now:\n"
-        f"• Plain text\n"
-        f"• Text with buttons: `[Button](https://url.com)`\n"
-        f"• Photo/Video with caption\n\n"
-        f"*Variables:* `{{user_name}}`, `{{user_id}}`, `{{bot_name}}`",
-        parse_mode="Markdown"
+        f"⚙️ *Setting Reply for Worker: {worker_name}*\n\n" + _WORKER_REPLY_HELP
     )
     
     return WAITING_WORKER_MESSAGE
@@ -161,11 +162,12 @@ async def receive_worker_message(update: Update, context: ContextTypes.DEFAULT_T
     """Receive and save worker reply"""
     user_id = update.effective_user.id
     
-    if user_id not in user_data_store:
+    session = await redis_client.get_session(user_id)
+    if session is None:
         await update.message.reply_text("❌ Session expired.")
         return ConversationHandler.END
     
-    worker_name = user_data_store[user_id]["worker"]
+    worker_name = session["worker"]
     
     # Parse message
     reply_content = reply_manager.parse_message_to_reply(update.message)
@@ -180,21 +182,18 @@ async def receive_worker_message(update: Update, context: ContextTypes.DEFAULT_T
     if success:
         await update.message.reply_text(
             f"✅ *Worker Reply Set!*\n\n"
-            f"All bots in `{worker_name}` will use this reply.",
-            parse_mode="Markdown"
+            f"All bots in `{worker_name}` will use this reply."
         )
     else:
         await update.message.reply_text("❌ Failed to set worker reply.")
     
-    del user_data_store[user_id]
+    await redis_client.delete_session(user_id)
     return ConversationHandler.END
 
 
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Cancel conversation"""
-    user_id = update.effective_user.id
-    if user_id in user_data_store:
-        del user_data_store[user_id]
+    await redis_client.delete_session(update.effective_user.id)
     
     await update.message.reply_text("❌ Operation cancelled.")
     return ConversationHandler.END
\ No newline at end of file
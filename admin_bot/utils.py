@@ -1,15 +1,29 @@
 import os
 import secrets
 import uuid
-from typing import List
+from typing import AbstractSet, FrozenSet, List, Tuple
 from telegram import InlineKeyboardButton
+from telegram.ext import filters
+
+# Admin user IDs, loaded by load_admin_ids() at startup
+ADMIN_IDS: FrozenSet[int] = frozenset()
+
+# Handler filter for admin-only entry points, filled by load_admin_ids()
+ADMIN_FILTER = filters.User()
+
+
+def load_admin_ids() -> FrozenSet[int]:
+    """Parse ADMIN_USER_IDS into ADMIN_IDS and ADMIN_FILTER (call after .env is loaded)"""
+    global ADMIN_IDS
+    admin_ids_str = os.getenv("ADMIN_USER_IDS", "")
+    ADMIN_IDS = frozenset(int(uid.strip()) for uid in admin_ids_str.split(",") if uid.strip())
+    ADMIN_FILTER.user_ids = ADMIN_IDS
+    return ADMIN_IDS
 
 
 def is_admin(user_id: int) -> bool:
     """Check if user is admin"""
-    admin_ids_str = os.getenv("ADMIN_USER_IDS", "")
-    admin_ids = [int(uid.strip()) for uid in admin_ids_str.split(",") if uid.strip()]
-    return user_id in admin_ids
+    return user_id in ADMIN_IDS
 
 
 def generate_bot_id() -> str:
@@ -28,19 +42,23 @@ def generate_broadcast_id() -> str:
 
 
 def parse_inline_buttons(entities) -> List[List[InlineKeyboardButton]]:
-    """Parse inline buttons from message entities"""
-    buttons = []
-    
-    if not entities:
-        return buttons
-    
-    for entity in entities:
-        if entity.type == "text_link":
-            # This is a URL button
-            button = InlineKeyboardButton(text=entity.url, url=entity.url)
-            buttons.append([button])
-    
-    return buttons
+    """Parse inline buttons from message entities (each text_link becomes a URL button)"""
+    return [
+        [InlineKeyboardButton(text=entity.url, url=entity.url)]
+        for entity in (entities or ())
+        if entity.type == "text_link"
+    ]
+
+
+def build_toggle_rows(page_bots: List[Tuple[str, str]], selected: AbstractSet[str], callback_prefix: str) -> List[List[InlineKeyboardButton]]:
+    """Build checkbox keyboard rows from (bot_id, username) pairs"""
+    return [
+        [InlineKeyboardButton(
+            f"{'☑' if bot_id in selected else '☐'} @{username}",
+            callback_data=f"{callback_prefix}{bot_id}"
+        )]
+        for bot_id, username in page_bots
+    ]
 
 
 def format_bot_stats(bot_data: dict, user_count: int) -> str:
@@ -0,0 +1,99 @@
+"""
+Bot Cache - Short-lived in-process caches for the (lite) bot lists and
+single bot documents, invalidated by the Database write paths (and, on
+workers, by changes announced on the bots:invalidate channel)
+"""
+
+import asyncio
+import time
+from typing import List, Dict, Any, Optional, Tuple
+
+# Seconds a fetched bot list stays fresh
+BOT_CACHE_TTL = 10.0
+
+# Seconds a fetched bot document stays fresh (per-message lookups on the worker)
+BOT_DOC_TTL = 30.0
+
+_cached: Optional[List[Dict[str, Any]]] = None
+_fetched_at = 0.0
+_generation = 0
+_lock = asyncio.Lock()
+_docs: Dict[str, Tuple[Dict[str, Any], float]] = {}
+_by_worker: Dict[str, Tuple[List[Dict[str, Any]], float]] = {}
+
+
+async def get_all_bots_cached(ttl: float = BOT_CACHE_TTL) -> List[Dict[str, Any]]:
+    """Get all bots (lite projection), served from cache while fresh (treat as read-only)"""
+    global _cached, _fetched_at
+    if _cached is not None and time.monotonic() - _fetched_at < ttl:
+        return _cached
+    
+    async with _lock:
+        # Another coroutine may have refreshed while we waited
+        if _cached is not None and time.monotonic() - _fetched_at < ttl:
+            return _cached
+        
+        from . import db
+        generation = _generation
+        bots = await db.get_all_bots_lite()
+        
+        # Don't store a list that a concurrent write already made stale
+        if generation == _generation:
+            _cached = bots
+            _fetched_at = time.monotonic()
+        return bots
+
+
+def peek_bot_cached(bot_id: str, ttl: float = BOT_DOC_TTL) -> Optional[Dict[str, Any]]:
+    """Get a bot document only if it is cached and fresh (no I/O)"""
+    hit = _docs.get(bot_id)
+    if hit and time.monotonic() - hit[1] < ttl:
+        return hit[0]
+    return None
+
+
+async def get_bot_cached(bot_id: str, ttl: float = BOT_DOC_TTL) -> Optional[Dict[str, Any]]:
+    """Get a full bot document, served from cache while fresh (treat as read-only)"""
+    bot_data = peek_bot_cached(bot_id, ttl)
+    if bot_data:
+        return bot_data
+    
+    from . import db
+    generation = _generation
+    bot_data = await db.get_bot(bot_id)
+    
+    # Misses aren't cached, a bot added elsewhere shows up on its next message
+    if bot_data and generation == _generation:
+        _docs[bot_id] = (bot_data, time.monotonic())
+    return bot_data
+
+
+async def get_worker_bots_cached(worker_name: str, ttl: float = BOT_CACHE_TTL) -> List[Dict[str, Any]]:
+    """Get a worker's bots (lite projection), served from cache while fresh (treat as read-only)"""
+    hit = _by_worker.get(worker_name)
+    if hit and time.monotonic() - hit[1] < ttl:
+        return hit[0]
+    
+    from . import db
+    generation = _generation
+    bots = await db.get_bots_by_worker_lite(worker_name)
+    
+    if generation == _generation:
+        _by_worker[worker_name] = (bots, time.monotonic())
+    return bots
+
+
+def prime_bots(bots: List[Dict[str, Any]]):
+    """Store freshly fetched full bot documents (e.g. loaded at startup)"""
+    now = time.monotonic()
+    for bot_data in bots:
+        _docs[bot_data["bot_id"]] = (bot_data, now)
+
+
+def invalidate_bots():
+    """Drop the cached bot lists and documents after a write"""
+    global _cached, _generation
+    _cached = None
+    _docs.clear()
+    _by_worker.clear()
+    _generation += 1
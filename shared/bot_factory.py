@@ -0,0 +1,39 @@
+"""
+Bot Factory - Creates telegram.Bot instances that share one HTTP/2
+connection pool instead of opening a new client per token
+"""
+
+from typing import Optional
+from telegram import Bot
+from telegram.request import HTTPXRequest
+
+_shared_request: Optional[HTTPXRequest] = None
+
+
+def get_shared_request() -> HTTPXRequest:
+    """Get or create the process-wide HTTPX request"""
+    global _shared_request
+    if _shared_request is None:
+        _shared_request = HTTPXRequest(
+            connection_pool_size=128,
+            http_version="2",  # multiplexes concurrent calls over few TLS sessions
+            connect_timeout=10.0,
+            read_timeout=10.0,
+            write_timeout=10.0,
+            pool_timeout=10.0
+        )
+    return _shared_request
+
+
+def make_bot(token: str) -> Bot:
+    """Create a Bot that reuses the shared connection pool"""
+    request = get_shared_request()
+    return Bot(token, request=request, get_updates_request=request)
+
+
+async def close_shared_request():
+    """Close the shared connection pool"""
+    global _shared_request
+    if _shared_request is not None:
+        await _shared_request.shutdown()
+        _shared_request = None
@@ -1,11 +1,40 @@
 # shared/crypto.py
 import os
 import base64
-from cryptography.fernet import Fernet
+from functools import lru_cache
+from typing import List, Optional
+from cryptography.fernet import Fernet, InvalidToken
 from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC  # ✓ CORRECT!
 
 
+@lru_cache(maxsize=4)
+def _derive_key(key: str) -> bytes:
+    """Derive a Fernet key from ENCRYPTION_KEY (PBKDF2, computed once per key)"""
+    # Convert any string to valid Fernet key using PBKDF2HMAC
+    kdf = PBKDF2HMAC(
+        algorithm=hashes.SHA256(),
+        length=32,
+        salt=b'telegram_bot_farm_salt',  # Fixed salt for consistency
+        iterations=100000,
+    )
+    
+    # Derive a proper 32-byte key and encode as base64
+    return base64.urlsafe_b64encode(kdf.derive(key.encode()))
+
+
+@lru_cache(maxsize=4096)
+def _decrypt(fernet: Fernet, token: str) -> str:
+    """Decrypt a token, memoized so reloaded bot tokens skip AES/HMAC"""
+    return fernet.decrypt(token.encode()).decode()
+
+
+@lru_cache(maxsize=4)
+def _get_fernet(key: bytes) -> Fernet:
+    """One shared Fernet per derived key (keeps _decrypt cache hits across instances)"""
+    return Fernet(key)
+
+
 class Crypto:
     def __init__(self):
         key = os.getenv("ENCRYPTION_KEY")
@@ -18,18 +47,8 @@ class Crypto:
         if len(key) < 32:
             raise ValueError("ENCRYPTION_KEY must be at least 32 characters")
         
-        # Convert any string to valid Fernet key using PBKDF2HMAC
-        kdf = PBKDF2HMAC(
-            algorithm=hashes.SHA256(),
-            length=32,
-            salt=b'telegram_bot_farm_salt',  # Fixed salt for consistency
-            iterations=100000,
-        )
-        
-        # Derive a proper 32-byte key and encode as base64
-        derived_key = kdf.derive(key.encode())
-        self.key = base64.urlsafe_b64encode(derived_key)
-        self.fernet = Fernet(self.key)
+        self.key = _derive_key(key)
+        self.fernet = _get_fernet(self.key)
     
     def encrypt(self, text: str) -> str:
         """Encrypt plain text to encrypted token"""
@@ -37,7 +56,18 @@ class Crypto:
     
     def decrypt(self, token: str) -> str:
         """Decrypt encrypted token to plain text"""
-        return self.fernet.decrypt(token.encode()).decode()
+        return _decrypt(self.fernet, token)
+    
+    def decrypt_many(self, tokens: List[str]) -> List[Optional[str]]:
+        """Decrypt a batch of tokens, None where a token can't be decrypted"""
+        fernet = self.fernet
+        plain = []
+        for token in tokens:
+            try:
+                plain.append(_decrypt(fernet, token))
+            except (InvalidToken, AttributeError, TypeError):
+                plain.append(None)
+        return plain
 
 
 def generate_encryption_key() -> str:
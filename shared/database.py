@@ -1,11 +1,38 @@
 import os
+import time
+import asyncio
 from motor.motor_asyncio import AsyncIOMotorClient
-from typing import Optional, List, Dict, Any
+from pymongo import IndexModel, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure
+from typing import Optional, List, Dict, Any, Set, Tuple
 from datetime import datetime
 import logging
 
+from .bot_cache import invalidate_bots
+
 logger = logging.getLogger(__name__)
 
+# How long global/worker replies are served from memory (seconds);
+# replies set from another process show up after at most this long
+REPLY_CACHE_TTL = 30.0
+
+# Write-behind for per-message user updates: flush at this many ops or after this long (seconds)
+USER_WRITE_BATCH = 500
+USER_WRITE_INTERVAL = 0.2
+
+# Bot fields needed by listings, pickers and counters
+BOT_LITE_PROJECTION = {
+    "_id": 0, "bot_id": 1, "bot_username": 1, "status": 1,
+    "assigned_worker": 1, "use_global_reply": 1, "use_worker_reply": 1
+}
+
+# Template fields shown by the template list; the reply text is cut to a preview server-side
+TEMPLATE_LITE_PROJECTION = {
+    "_id": 0, "template_id": 1, "name": 1, "description": 1, "usage_count": 1,
+    "name_html": 1, "desc_html": 1, "preview_html": 1,
+    "preview": {"$substrCP": [{"$ifNull": ["$content.text", ""]}, 0, 40]}
+}
+
 
 class Database:
     """MongoDB connection handler"""
@@ -13,89 +40,289 @@ class Database:
     def __init__(self):
         self.client: Optional[AsyncIOMotorClient] = None
         self.db = None
+        # (value, fetched_at) caches for the per-message reply lookups
+        self._global_reply_cache: Optional[Tuple[Optional[Dict[str, Any]], float]] = None
+        self._worker_reply_cache: Dict[str, Tuple[Optional[Dict[str, Any]], float]] = {}
+        # Queued user upserts (None stops the writer), drained by the _user_writer task
+        self._user_writes: Optional[asyncio.Queue] = None
+        self._user_writer: Optional[asyncio.Task] = None
+        # Whether the bot_username index is unique (set by create_indexes)
+        self.username_unique = False
     
     async def connect(self):
         """Connect to MongoDB"""
         uri = os.getenv("MONGODB_URI", "mongodb://localhost:27017")
         db_name = os.getenv("MONGODB_DB", "bot_farm")
         
-        self.client = AsyncIOMotorClient(uri)
+        self.client = AsyncIOMotorClient(
+            uri,
+            maxPoolSize=200,
+            minPoolSize=20,
+            compressors="zstd,zlib",  # zstd needs the zstandard package, zlib is the fallback
+            retryWrites=True,
+            serverSelectionTimeoutMS=3000,
+            waitQueueTimeoutMS=2000
+        )
         self.db = self.client[db_name]
         
         # Create indexes
         await self.create_indexes()
+        
+        self._user_writes = asyncio.Queue(maxsize=USER_WRITE_BATCH * 20)
+        self._user_writer = asyncio.create_task(self._write_users())
         logger.info(f"Connected to MongoDB: {db_name}")
     
+    async def ping(self) -> bool:
+        """Round-trip to MongoDB"""
+        await self.client.admin.command("ping")
+        return True
+    
     async def create_indexes(self):
-        """Create required indexes"""
-        # Bots collection
-        await self.db.bots.create_index("bot_id", unique=True)
-        await self.db.bots.create_index("assigned_worker")
-        await self.db.bots.create_index("status")
-        
-        # Users collection
-        await self.db.users.create_index([("bot_id", 1), ("user_id", 1)], unique=True)
-        await self.db.users.create_index([("last_seen", -1)])
-        await self.db.users.create_index("bot_id")
+        """Create required indexes (one createIndexes per collection, all concurrently)"""
+        await asyncio.gather(
+            # Bots collection
+            self.db.bots.create_indexes([
+                IndexModel("bot_id", unique=True),
+                IndexModel([("assigned_worker", 1), ("bot_id", 1)]),
+                IndexModel("status"),
+            ]),
+            self.create_unique_username_index(),
+            
+            # Users collection
+            self.db.users.create_indexes([
+                IndexModel([("bot_id", 1), ("user_id", 1)], unique=True),
+                IndexModel([("last_seen", -1)]),
+                IndexModel("bot_id"),
+            ]),
+            
+            # Broadcasts collection
+            self.db.broadcasts.create_indexes([
+                IndexModel("broadcast_id", unique=True),
+                IndexModel("status"),
+                IndexModel([("created_at", -1)]),
+            ]),
+            
+            # Templates collection
+            self.db.templates.create_indexes([
+                IndexModel("template_id", unique=True),
+                IndexModel("name"),
+            ]),
+            
+            # Global replies collection
+            self.db.global_replies.create_index("reply_id", unique=True),
+            
+            # Worker replies collection
+            self.db.worker_replies.create_index("worker_name", unique=True),
+        )
         
-        # Broadcasts collection
-        await self.db.broadcasts.create_index("broadcast_id", unique=True)
-        await self.db.broadcasts.create_index("status")
-        await self.db.broadcasts.create_index([("created_at", -1)])
+        logger.info("Database indexes created")
+    
+    async def create_unique_username_index(self):
+        """Make bot_username unique, replacing an older non-unique index when possible"""
+        existing = (await self.db.bots.index_information()).get("bot_username_1")
+        if existing and existing.get("unique"):
+            self.username_unique = True
+            return
         
-        # Templates collection
-        await self.db.templates.create_index("template_id", unique=True)
-        await self.db.templates.create_index("name")
+        # Pre-existing duplicates - keep (or create) a plain index so lookups stay fast
+        duplicates = await self.db.bots.aggregate([
+            {"$group": {"_id": "$bot_username", "count": {"$sum": 1}}},
+            {"$match": {"count": {"$gt": 1}}},
+            {"$limit": 1}
+        ]).to_list(length=1)
+        if duplicates:
+            logger.warning(f"Duplicate bot_username values (e.g. {duplicates[0]['_id']!r}), keeping a non-unique index")
+            if not existing:
+                await self.db.bots.create_index("bot_username")
+            return
         
-        # Global replies collection
-        await self.db.global_replies.create_index("reply_id", unique=True)
+        if existing:
+            try:
+                await self.db.bots.drop_index("bot_username_1")
+            except OperationFailure as e:
+                # IndexNotFound - another process starting up dropped it first
+                if e.code != 27:
+                    raise
         
-        # Worker replies collection
-        await self.db.worker_replies.create_index("worker_name", unique=True)
+        try:
+            await self.db.bots.create_index("bot_username", unique=True)
+        except OperationFailure as e:
+            # Raced with a duplicate insert or another process building the index
+            logger.warning(f"Could not create unique bot_username index: {e}")
+            existing = (await self.db.bots.index_information()).get("bot_username_1")
+            if not existing:
+                await self.db.bots.create_index("bot_username")
         
-        logger.info("Database indexes created")
+        existing = (await self.db.bots.index_information()).get("bot_username_1")
+        self.username_unique = bool(existing and existing.get("unique"))
     
     async def disconnect(self):
         """Close MongoDB connection"""
+        if self._user_writer:
+            # Let the writer finish the batch it holds, then write anything queued after it
+            await self._user_writes.put(None)
+            await self._user_writer
+            self._user_writer = None
+            await self.flush_user_writes()
+        
         if self.client:
             self.client.close()
             logger.info("Disconnected from MongoDB")
     
     # Bot operations
     async def insert_bot(self, bot_data: Dict[str, Any]) -> bool:
-        """Insert a new bot"""
+        """Insert a new bot, raises DuplicateKeyError if the username exists"""
+        # Without a unique index (pre-existing duplicates) check explicitly
+        if not self.username_unique and await self.db.bots.find_one(
+            {"bot_username": bot_data["bot_username"]}, {"_id": 1}
+        ):
+            raise DuplicateKeyError(f"Bot username {bot_data['bot_username']} already exists")
+        
         try:
             await self.db.bots.insert_one(bot_data)
+            invalidate_bots()
             return True
+        except DuplicateKeyError:
+            raise
         except Exception as e:
             logger.error(f"Error inserting bot: {e}")
             return False
     
+    async def insert_bots_many(self, bots_data: List[Dict[str, Any]]) -> Dict[int, Dict[str, Any]]:
+        """Insert many bots in one round-trip, returns {index: {code, errmsg}} for failed docs"""
+        if not bots_data:
+            return {}
+        
+        try:
+            await self.db.bots.insert_many(bots_data, ordered=False)
+            return {}
+        except BulkWriteError as e:
+            return {
+                err["index"]: {"code": err.get("code"), "errmsg": err.get("errmsg", "Database insert failed")}
+                for err in e.details.get("writeErrors", [])
+            }
+        except Exception as e:
+            logger.error(f"Error inserting bots: {e}")
+            return {idx: {"code": None, "errmsg": "Database insert failed"} for idx in range(len(bots_data))}
+        finally:
+            invalidate_bots()
+    
     async def get_bot(self, bot_id: str) -> Optional[Dict[str, Any]]:
         """Get bot by ID"""
         return await self.db.bots.find_one({"bot_id": bot_id})
     
+    async def get_existing_bot_usernames(self, usernames: List[str]) -> Set[str]:
+        """Return which of the given usernames are already registered"""
+        if not usernames:
+            return set()
+        
+        cursor = self.db.bots.find(
+            {"bot_username": {"$in": usernames}},
+            {"bot_username": 1, "_id": 0}
+        )
+        return {doc["bot_username"] async for doc in cursor}
+    
+    async def get_worker_names(self) -> List[str]:
+        """Get sorted distinct worker names (served from the assigned_worker index)"""
+        return sorted(await self.db.bots.distinct("assigned_worker"))
+    
+    async def get_bot_ids(self) -> List[str]:
+        """Get the ids of all existing bots (served from the bot_id index)"""
+        return await self.db.bots.distinct("bot_id")
+    
     async def get_bots_by_worker(self, worker_name: str) -> List[Dict[str, Any]]:
         """Get all bots assigned to a worker"""
         cursor = self.db.bots.find({"assigned_worker": worker_name})
         return await cursor.to_list(length=None)
     
+    async def get_bots_by_worker_lite(self, worker_name: str) -> List[Dict[str, Any]]:
+        """Get a worker's bots with only the fields needed for listing"""
+        cursor = self.db.bots.find({"assigned_worker": worker_name}, BOT_LITE_PROJECTION)
+        return await cursor.to_list(length=None)
+    
+    async def get_worker_bots_in(self, worker_name: str, bot_ids: List[str]) -> List[Dict[str, Any]]:
+        """Get the bots among bot_ids that are assigned to a worker (one query)"""
+        cursor = self.db.bots.find({"assigned_worker": worker_name, "bot_id": {"$in": bot_ids}})
+        return await cursor.to_list(length=None)
+    
     async def update_bot_status(self, bot_id: str, status: str) -> bool:
         """Update bot status"""
         result = await self.db.bots.update_one(
             {"bot_id": bot_id},
-            {"$set": {"status": status, "last_health_check": datetime.utcnow()}}
+            {"$set": {"status": status}, "$currentDate": {"last_health_check": True}}
         )
+        invalidate_bots()
         return result.modified_count > 0
     
+    async def update_bots_status(self, statuses: Dict[str, str]) -> int:
+        """Update status for many bots in a single bulk write"""
+        if not statuses:
+            return 0
+        
+        # Server-side timestamp, like update_bot_status
+        ops = [
+            UpdateOne(
+                {"bot_id": bot_id},
+                {"$set": {"status": status}, "$currentDate": {"last_health_check": True}}
+            )
+            for bot_id, status in statuses.items()
+        ]
+        result = await self.db.bots.bulk_write(ops, ordered=False)
+        invalidate_bots()
+        return result.modified_count
+    
     async def get_all_bots(self) -> List[Dict[str, Any]]:
         """Get all bots"""
         cursor = self.db.bots.find()
         return await cursor.to_list(length=None)
     
+    async def get_all_bots_lite(self) -> List[Dict[str, Any]]:
+        """Get all bots without tokens or reply payloads (for listings and pickers)"""
+        cursor = self.db.bots.find({}, BOT_LITE_PROJECTION)
+        return await cursor.to_list(length=None)
+    
+    async def list_bots_page(self, skip: int = 0, limit: int = 20) -> List[Dict[str, Any]]:
+        """Get one page of bots with only the fields needed for listing"""
+        cursor = self.db.bots.find({}, BOT_LITE_PROJECTION).sort("_id", 1).skip(skip).limit(limit).batch_size(limit)
+        return await cursor.to_list(length=limit)
+    
+    async def count_bots(self) -> int:
+        """Get the (estimated) total number of bots"""
+        return await self.db.bots.estimated_document_count()
+    
+    async def get_bot_stats(self) -> Dict[str, Any]:
+        """Get bot counters by status, reply mode and worker in one aggregation"""
+        pipeline = [{"$facet": {
+            "by_status": [{"$group": {"_id": "$status", "n": {"$sum": 1}}}],
+            "by_reply": [{"$group": {
+                "_id": {
+                    "g": {"$ifNull": ["$use_global_reply", True]},
+                    "w": {"$ifNull": ["$use_worker_reply", False]}
+                },
+                "n": {"$sum": 1}
+            }}],
+            "by_worker": [{"$group": {"_id": "$assigned_worker", "n": {"$sum": 1}}}]
+        }}]
+        facets = (await self.db.bots.aggregate(pipeline).to_list(length=1))[0]
+        
+        by_status = {row["_id"]: row["n"] for row in facets["by_status"]}
+        total = sum(by_status.values())
+        global_reply = sum(row["n"] for row in facets["by_reply"] if row["_id"]["g"])
+        worker_reply = sum(row["n"] for row in facets["by_reply"] if row["_id"]["w"] and not row["_id"]["g"])
+        
+        return {
+            "total": total,
+            "by_status": by_status,
+            "global_reply": global_reply,
+            "worker_reply": worker_reply,
+            "custom_reply": total - global_reply - worker_reply,
+            "by_worker": {row["_id"]: row["n"] for row in facets["by_worker"]}
+        }
+    
     async def delete_bot(self, bot_id: str) -> bool:
         """Delete a bot"""
         result = await self.db.bots.delete_one({"bot_id": bot_id})
+        await self.publish_bots_changed(bot_id)
         return result.deleted_count > 0
     
     # User operations
@@ -115,20 +342,112 @@ class Database:
             logger.error(f"Error upserting user: {e}")
             return False
     
-    async def get_users_by_bot(self, bot_id: str, skip: int = 0, limit: int = 1000):
-        """Get users for a bot (paginated)"""
-        cursor = self.db.users.find(
-            {"bot_id": bot_id}
-        ).skip(skip).limit(limit)
+    async def queue_user_message(
+        self,
+        user_id: int,
+        bot_id: str,
+        seen_at: datetime,
+        first_name: Optional[str],
+        username: Optional[str]
+    ):
+        """Queue a user upsert for an incoming message (written in batches)"""
+        await self._user_writes.put(UpdateOne(
+            {"user_id": user_id, "bot_id": bot_id},
+            {
+                "$set": {"first_name": first_name, "username": username},
+                "$max": {"last_seen": seen_at},
+                "$setOnInsert": {"first_seen": seen_at},
+                "$inc": {"message_count": 1}
+            },
+            upsert=True
+        ))
+    
+    async def _write_users(self):
+        """Background task: bulk-write queued user upserts"""
+        loop = asyncio.get_running_loop()
+        stopping = False
+        while not stopping:
+            op = await self._user_writes.get()
+            if op is None:
+                return
+            ops = [op]
+            deadline = loop.time() + USER_WRITE_INTERVAL
+            while len(ops) < USER_WRITE_BATCH:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    op = await asyncio.wait_for(self._user_writes.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if op is None:
+                    stopping = True
+                    break
+                ops.append(op)
+            await self._bulk_write_users(ops)
+    
+    async def flush_user_writes(self):
+        """Write any user upserts still queued"""
+        if not self._user_writes:
+            return
+        ops = []
+        while not self._user_writes.empty():
+            op = self._user_writes.get_nowait()
+            if op is not None:
+                ops.append(op)
+        if ops:
+            await self._bulk_write_users(ops)
+    
+    async def _bulk_write_users(self, ops: List[UpdateOne]):
+        """Send one unordered bulk write of user upserts"""
+        try:
+            await self.db.users.bulk_write(ops, ordered=False)
+        except Exception as e:
+            logger.error(f"Error writing {len(ops)} user updates: {e}")
+    
+    async def get_users_by_bot(
+        self,
+        bot_id: str,
+        skip: int = 0,
+        limit: int = 1000,
+        before: Optional[Tuple[datetime, Any]] = None
+    ):
+        """Get users for a bot, most recently seen first (paginated)"""
+        # before is the previous page's last (last_seen, _id); _id breaks ties
+        # between users seen in the same second, so none are skipped between pages
+        query = {"bot_id": bot_id}
+        if before is not None:
+            last_seen, last_id = before
+            query["$or"] = [
+                {"last_seen": {"$lt": last_seen}},
+                {"last_seen": last_seen, "_id": {"$lt": last_id}}
+            ]
+        
+        cursor = self.db.users.find(query).sort([("last_seen", -1), ("_id", -1)]).skip(skip).limit(limit)
         return await cursor.to_list(length=limit)
     
     async def count_users_by_bot(self, bot_id: str) -> int:
         """Count total users for a bot"""
         return await self.db.users.count_documents({"bot_id": bot_id})
     
+    async def count_users_by_bots(self, bot_ids: List[str], batch_size: int = 1000) -> Dict[str, int]:
+        """Count users per bot for many bots in one aggregation per batch"""
+        counts = {}
+        for i in range(0, len(bot_ids), batch_size):
+            pipeline = [
+                {"$match": {"bot_id": {"$in": bot_ids[i:i + batch_size]}}},
+                {"$group": {"_id": "$bot_id", "count": {"$sum": 1}}}
+            ]
+            async for row in self.db.users.aggregate(pipeline):
+                counts[row["_id"]] = row["count"]
+        return counts
+    
     async def get_all_users_for_bots(self, bot_ids: List[str]):
-        """Get all users across multiple bots"""
-        cursor = self.db.users.find({"bot_id": {"$in": bot_ids}})
+        """Get all users across multiple bots (user_id and bot_id only)"""
+        cursor = self.db.users.find(
+            {"bot_id": {"$in": bot_ids}},
+            {"_id": 0, "user_id": 1, "bot_id": 1}
+        ).batch_size(1000)
         async for user in cursor:
             yield user
     
@@ -167,6 +486,13 @@ class Database:
         )
         return result.modified_count > 0
     
+    async def increment_broadcast_stats(self, broadcast_id: str, sent_delta: int, failed_delta: int):
+        """Add sent/failed deltas to a broadcast's stored totals"""
+        await self.db.broadcasts.update_one(
+            {"broadcast_id": broadcast_id},
+            {"$inc": {"sent_count": sent_delta, "failed_count": failed_delta}}
+        )
+    
     # Template operations
     async def insert_template(self, template_data: Dict[str, Any]) -> bool:
         """Insert a new template"""
@@ -186,6 +512,18 @@ class Database:
         cursor = self.db.templates.find().sort("created_at", -1)
         return await cursor.to_list(length=None)
     
+    async def get_all_templates_lite(self) -> List[Dict[str, Any]]:
+        """Get all templates with only the fields needed for listing"""
+        cursor = self.db.templates.aggregate([
+            {"$sort": {"created_at": -1}},
+            {"$project": TEMPLATE_LITE_PROJECTION}
+        ])
+        return await cursor.to_list(length=None)
+    
+    async def count_templates(self) -> int:
+        """Get the (estimated) total number of templates"""
+        return await self.db.templates.estimated_document_count()
+    
     async def delete_template(self, template_id: str) -> bool:
         """Delete a template"""
         result = await self.db.templates.delete_one({"template_id": template_id})
@@ -207,14 +545,26 @@ class Database:
                 {"$set": reply_data},
                 upsert=True
             )
+            await self.publish_bots_changed()
             return True
         except Exception as e:
             logger.error(f"Error setting global reply: {e}")
             return False
     
     async def get_global_reply(self) -> Optional[Dict[str, Any]]:
-        """Get global reply"""
-        return await self.db.global_replies.find_one({"reply_id": "global_default"})
+        """Get global reply (cached for REPLY_CACHE_TTL)"""
+        cached = self._global_reply_cache
+        if cached and time.monotonic() - cached[1] < REPLY_CACHE_TTL:
+            return cached[0]
+        
+        reply = await self.db.global_replies.find_one({"reply_id": "global_default"})
+        self._global_reply_cache = (reply, time.monotonic())
+        return reply
+    
+    async def delete_global_reply(self):
+        """Delete global reply"""
+        await self.db.global_replies.delete_one({"reply_id": "global_default"})
+        await self.publish_bots_changed()
     
     # Worker reply operations
     async def set_worker_reply(self, worker_name: str, reply_data: Dict[str, Any]) -> bool:
@@ -226,14 +576,37 @@ class Database:
                 {"$set": reply_data},
                 upsert=True
             )
+            await self.publish_bots_changed()
             return True
         except Exception as e:
             logger.error(f"Error setting worker reply: {e}")
             return False
     
     async def get_worker_reply(self, worker_name: str) -> Optional[Dict[str, Any]]:
-        """Get worker reply"""
-        return await self.db.worker_replies.find_one({"worker_name": worker_name})
+        """Get worker reply (cached for REPLY_CACHE_TTL)"""
+        cached = self._worker_reply_cache.get(worker_name)
+        if cached and time.monotonic() - cached[1] < REPLY_CACHE_TTL:
+            return cached[0]
+        
+        reply = await self.db.worker_replies.find_one({"worker_name": worker_name})
+        self._worker_reply_cache[worker_name] = (reply, time.monotonic())
+        return reply
+    
+    def clear_reply_caches(self):
+        """Drop the cached global and worker replies"""
+        self._global_reply_cache = None
+        self._worker_reply_cache.clear()
+    
+    async def publish_bots_changed(self, bot_id: str = "*"):
+        """Drop the local bot and reply caches and tell the other processes to do the same"""
+        invalidate_bots()
+        self.clear_reply_caches()
+        from . import redis_client
+        try:
+            await redis_client.publish_bots_invalidate(bot_id)
+        except Exception as e:
+            # Other processes still catch up once their caches expire
+            logger.warning(f"Could not publish bot invalidation: {e}")
     
     # Bulk bot operations
     async def update_bots_reply(self, bot_ids: List[str], auto_reply: Dict[str, Any]) -> int:
@@ -242,6 +615,16 @@ class Database:
             {"bot_id": {"$in": bot_ids}},
             {"$set": {"auto_reply": auto_reply, "use_global_reply": False, "use_worker_reply": False}}
         )
+        await self.publish_bots_changed()
+        return result.modified_count
+    
+    async def update_all_bots_reply(self, auto_reply: Dict[str, Any]) -> int:
+        """Update auto reply for every bot"""
+        result = await self.db.bots.update_many(
+            {},
+            {"$set": {"auto_reply": auto_reply, "use_global_reply": False, "use_worker_reply": False}}
+        )
+        await self.publish_bots_changed()
         return result.modified_count
     
     async def enable_global_reply_for_bots(self, bot_ids: List[str]) -> int:
@@ -250,6 +633,7 @@ class Database:
             {"bot_id": {"$in": bot_ids}},
             {"$set": {"use_global_reply": True, "auto_reply": None}}
         )
+        await self.publish_bots_changed()
         return result.modified_count
     
     async def enable_worker_reply_for_bots(self, bot_ids: List[str]) -> int:
@@ -258,6 +642,7 @@ class Database:
             {"bot_id": {"$in": bot_ids}},
             {"$set": {"use_worker_reply": True, "use_global_reply": False, "auto_reply": None}}
         )
+        await self.publish_bots_changed()
         return result.modified_count
 
 
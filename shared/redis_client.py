@@ -1,16 +1,43 @@
 import os
+import orjson
 import redis.asyncio as aioredis
-from typing import Optional
+from redis.asyncio.retry import Retry
+from redis.backoff import ExponentialBackoff
+from typing import Any, Optional
 import logging
 
 logger = logging.getLogger(__name__)
 
+# Idle lifetime of an admin conversation session (seconds)
+SESSION_TTL = 900
+
+# Pub/sub channel announcing bot and reply changes (a bot_id, or "*" for all)
+BOTS_INVALIDATE_CHANNEL = "bots:invalidate"
+
+# Max pooled connections per process (callers wait for a free one beyond that)
+REDIS_MAX_CONNECTIONS = 64
+
+# Add a batch of send results to a broadcast hash and return its status
+_INCREMENT_COUNTS_LUA = """
+if ARGV[1] ~= '0' then redis.call('HINCRBY', KEYS[1], 'sent', ARGV[1]) end
+if ARGV[2] ~= '0' then redis.call('HINCRBY', KEYS[1], 'failed', ARGV[2]) end
+return redis.call('HGET', KEYS[1], 'status')
+"""
+
+# How long a finished broadcast's live state is kept (seconds)
+BROADCAST_STATE_TTL = 86400 * 7
+
+# Idle lifetime of a cached bot file_id (seconds)
+FILE_ID_TTL = 86400 * 30
+
 
 class RedisClient:
     """Redis connection handler for broadcast state"""
     
     def __init__(self):
         self.client: Optional[aioredis.Redis] = None
+        self.pool: Optional[aioredis.BlockingConnectionPool] = None
+        self._increment_counts = None
     
     async def connect(self):
         """Connect to Redis"""
@@ -18,91 +45,162 @@ class RedisClient:
         port = int(os.getenv("REDIS_PORT", 6379))
         password = os.getenv("REDIS_PASSWORD", None)
         
-        self.client = await aioredis.from_url(
+        self.pool = aioredis.BlockingConnectionPool.from_url(
             f"redis://{host}:{port}",
             password=password,
             encoding="utf-8",
-            decode_responses=True
+            decode_responses=True,
+            max_connections=REDIS_MAX_CONNECTIONS,
+            socket_keepalive=True,
+            health_check_interval=30,
+            retry=Retry(ExponentialBackoff(), 3)
         )
+        self.client = aioredis.Redis(connection_pool=self.pool)
+        # Runs via EVALSHA, loading the script on first use
+        self._increment_counts = self.client.register_script(_INCREMENT_COUNTS_LUA)
         logger.info(f"Connected to Redis: {host}:{port}")
     
     async def disconnect(self):
         """Close Redis connection"""
         if self.client:
             await self.client.close()
+            await self.pool.disconnect()
             logger.info("Disconnected from Redis")
     
-    # Broadcast state operations
+    async def ping(self) -> bool:
+        """Round-trip to Redis (opens the first pooled connection)"""
+        return await self.client.ping()
+    
+    # Broadcast state operations (one hash per broadcast)
+    @staticmethod
+    def _broadcast_key(broadcast_id: str) -> str:
+        return f"broadcast:{broadcast_id}"
+    
     async def set_broadcast_index(self, broadcast_id: str, index: int):
         """Set current broadcast index"""
-        await self.client.set(f"broadcast:{broadcast_id}:current_index", index)
+        await self.client.hset(self._broadcast_key(broadcast_id), "current_index", index)
     
     async def get_broadcast_index(self, broadcast_id: str) -> int:
         """Get current broadcast index"""
-        value = await self.client.get(f"broadcast:{broadcast_id}:current_index")
+        value = await self.client.hget(self._broadcast_key(broadcast_id), "current_index")
         return int(value) if value else 0
     
     async def increment_sent(self, broadcast_id: str) -> int:
         """Increment sent counter"""
-        return await self.client.incr(f"broadcast:{broadcast_id}:sent")
+        return await self.client.hincrby(self._broadcast_key(broadcast_id), "sent", 1)
     
     async def increment_failed(self, broadcast_id: str) -> int:
         """Increment failed counter"""
-        return await self.client.incr(f"broadcast:{broadcast_id}:failed")
+        return await self.client.hincrby(self._broadcast_key(broadcast_id), "failed", 1)
+    
+    async def increment_counts(self, broadcast_id: str, sent: int, failed: int) -> str:
+        """Add a batch of sent/failed results and read the status in one atomic call"""
+        status = await self._increment_counts(keys=[self._broadcast_key(broadcast_id)], args=[sent, failed])
+        return status if status else "unknown"
     
     async def get_broadcast_stats(self, broadcast_id: str) -> dict:
         """Get all broadcast stats"""
-        pipe = self.client.pipeline()
-        pipe.get(f"broadcast:{broadcast_id}:current_index")
-        pipe.get(f"broadcast:{broadcast_id}:sent")
-        pipe.get(f"broadcast:{broadcast_id}:failed")
-        pipe.get(f"broadcast:{broadcast_id}:status")
-        
-        results = await pipe.execute()
+        data = await self.client.hgetall(self._broadcast_key(broadcast_id))
         
         return {
-            "current_index": int(results[0]) if results[0] else 0,
-            "sent": int(results[1]) if results[1] else 0,
-            "failed": int(results[2]) if results[2] else 0,
-            "status": results[3] if results[3] else "unknown"
+            "current_index": int(data.get("current_index") or 0),
+            "sent": int(data.get("sent") or 0),
+            "failed": int(data.get("failed") or 0),
+            "status": data.get("status") or "unknown"
         }
     
     async def set_broadcast_status(self, broadcast_id: str, status: str):
-        """Set broadcast status"""
-        await self.client.set(f"broadcast:{broadcast_id}:status", status)
+        """Set broadcast status and notify workers on its control channel"""
+        key = self._broadcast_key(broadcast_id)
+        pipe = self.client.pipeline(transaction=False)
+        pipe.hset(key, "status", status)
+        if status == "completed":
+            # Finished broadcasts purge themselves
+            pipe.expire(key, BROADCAST_STATE_TTL)
+        pipe.publish(f"broadcast:{broadcast_id}:control", status)
+        await pipe.execute()
+    
+    async def publish_bots_invalidate(self, bot_id: str = "*"):
+        """Tell the workers to drop their cached bots and replies"""
+        await self.client.publish(BOTS_INVALIDATE_CHANNEL, bot_id)
     
     async def get_broadcast_status(self, broadcast_id: str) -> str:
         """Get broadcast status"""
-        status = await self.client.get(f"broadcast:{broadcast_id}:status")
+        status = await self.client.hget(self._broadcast_key(broadcast_id), "status")
         return status if status else "unknown"
     
     async def delete_broadcast_data(self, broadcast_id: str):
         """Delete all broadcast data"""
-        keys = [
-            f"broadcast:{broadcast_id}:current_index",
-            f"broadcast:{broadcast_id}:sent",
-            f"broadcast:{broadcast_id}:failed",
-            f"broadcast:{broadcast_id}:status"
-        ]
-        await self.client.delete(*keys)
+        await self.client.delete(self._broadcast_key(broadcast_id))
     
     async def init_broadcast(self, broadcast_id: str):
         """Initialize broadcast counters"""
-        pipe = self.client.pipeline()
-        pipe.set(f"broadcast:{broadcast_id}:current_index", 0)
-        pipe.set(f"broadcast:{broadcast_id}:sent", 0)
-        pipe.set(f"broadcast:{broadcast_id}:failed", 0)
-        pipe.set(f"broadcast:{broadcast_id}:status", "running")
-        await pipe.execute()
+        await self.client.hset(
+            self._broadcast_key(broadcast_id),
+            mapping={"current_index": 0, "sent": 0, "failed": 0, "status": "running"}
+        )
     
     # Bot file_id cache
     async def set_file_id(self, bot_id: str, file_key: str, file_id: str):
         """Cache file_id for a bot"""
-        await self.client.set(f"bot:{bot_id}:file:{file_key}", file_id, ex=86400 * 30)
+        await self.client.set(f"bot:{bot_id}:file:{file_key}", file_id, ex=FILE_ID_TTL)
     
     async def get_file_id(self, bot_id: str, file_key: str) -> Optional[str]:
-        """Get cached file_id"""
-        return await self.client.get(f"bot:{bot_id}:file:{file_key}")
+        """Get cached file_id, refreshing its TTL so files in use stay cached"""
+        return await self.client.getex(f"bot:{bot_id}:file:{file_key}", ex=FILE_ID_TTL)
+    
+    # Query result cache
+    async def get_cached(self, key: str) -> Optional[Any]:
+        """Get a cached JSON value"""
+        value = await self.client.get(f"cache:{key}")
+        return orjson.loads(value) if value else None
+    
+    async def set_cached(self, key: str, value: Any, ttl: int):
+        """Cache a JSON-serializable value for ttl seconds"""
+        await self.client.set(f"cache:{key}", orjson.dumps(value, default=str), ex=ttl)
+    
+    async def set_cached_many(self, values: dict, ttl: int):
+        """Cache several JSON-serializable values in one round-trip"""
+        pipe = self.client.pipeline(transaction=False)
+        for key, value in values.items():
+            pipe.set(f"cache:{key}", orjson.dumps(value, default=str), ex=ttl)
+        await pipe.execute()
+    
+    async def invalidate_cached(self, key: str):
+        """Drop a cached value"""
+        await self.client.delete(f"cache:{key}")
+    
+    # Admin conversation sessions (hash of JSON-encoded fields per user)
+    async def start_session(self, user_id: int, data: dict):
+        """Replace a user's session with new data"""
+        key = f"ud:{user_id}"
+        pipe = self.client.pipeline()
+        pipe.delete(key)
+        pipe.hset(key, mapping={k: orjson.dumps(v, default=str) for k, v in data.items()})
+        pipe.expire(key, SESSION_TTL)
+        await pipe.execute()
+    
+    async def update_session(self, user_id: int, data: dict):
+        """Set fields on a user's session and refresh its TTL"""
+        key = f"ud:{user_id}"
+        pipe = self.client.pipeline()
+        pipe.hset(key, mapping={k: orjson.dumps(v, default=str) for k, v in data.items()})
+        pipe.expire(key, SESSION_TTL)
+        await pipe.execute()
+    
+    async def get_session(self, user_id: int, *fields: str) -> Optional[dict]:
+        """Get a user's session (or just the given fields), None if missing or expired"""
+        key = f"ud:{user_id}"
+        if fields:
+            values = await self.client.hmget(key, fields)
+            data = {k: v for k, v in zip(fields, values) if v is not None}
+        else:
+            data = await self.client.hgetall(key)
+        return {k: orjson.loads(v) for k, v in data.items()} if data else None
+    
+    async def delete_session(self, user_id: int):
+        """Delete a user's session"""
+        await self.client.delete(f"ud:{user_id}")
 
 
 # Global Redis instance
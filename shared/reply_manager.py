@@ -4,8 +4,27 @@ Bot-level > Worker-level > Global-level
 """
 
 import re
-from typing import Optional, Dict, Any
+from functools import lru_cache
+from typing import Optional, Dict, Any, List, Tuple
 from datetime import datetime
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+from .bot_cache import get_bot_cached
+
+# [text](url) button syntax in reply text
+_BUTTON_RE = re.compile(r'\[([^\]]+)\]\(([^\)]+)\)')
+
+# Supported {variable} placeholders
+_VARIABLE_RE = re.compile(r'\{(?:user_name|user_id|username|bot_name|bot_username)\}')
+
+
+@lru_cache(maxsize=256)
+def _keyboard_from_rows(rows: Tuple[Tuple[Tuple[str, str], ...], ...]) -> InlineKeyboardMarkup:
+    """Build (and memoize) a URL-button keyboard from hashable (text, url) rows"""
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton(text=text, url=url) for text, url in row]
+        for row in rows
+    ])
 
 
 class ReplyManager:
@@ -13,8 +32,8 @@ class ReplyManager:
     
     @staticmethod
     def replace_variables(text: str, user_data: Dict[str, Any], bot_data: Dict[str, Any]) -> str:
-        """Replace variables in text"""
-        if not text:
+        """Replace variables in text (single pass)"""
+        if not text or '{' not in text:
             return text
         
         replacements = {
@@ -25,14 +44,10 @@ class ReplyManager:
             '{bot_username}': bot_data.get('bot_username', ''),
         }
         
-        result = text
-        for var, value in replacements.items():
-            result = result.replace(var, value)
-        
-        return result
+        return _VARIABLE_RE.sub(lambda match: replacements[match.group(0)], text)
     
     @staticmethod
-    async def get_reply_for_bot(db, bot_id: str) -> Optional[Dict[str, Any]]:
+    async def get_reply_for_bot(db, bot_id: str, bot_data: Optional[Dict[str, Any]] = None) -> Optional[Dict[str, Any]]:
         """
         Get the appropriate reply for a bot based on priority:
         1. Bot-specific reply (highest priority)
@@ -40,8 +55,9 @@ class ReplyManager:
         3. Global reply (lowest priority)
         """
         
-        # Get bot data
-        bot_data = await db.get_bot(bot_id)
+        # Get bot data unless the caller has it (worker and global replies are cached by db as well)
+        if bot_data is None:
+            bot_data = await get_bot_cached(bot_id)
         if not bot_data:
             return None
         
@@ -64,6 +80,15 @@ class ReplyManager:
         # Fallback: Bot-specific if exists
         return bot_data.get('auto_reply')
     
+    @staticmethod
+    def build_keyboard(buttons: Optional[List[List[Dict[str, str]]]]) -> Optional[InlineKeyboardMarkup]:
+        """Inline keyboard for stored reply buttons, shared across messages with the same buttons"""
+        if not buttons:
+            return None
+        return _keyboard_from_rows(tuple(
+            tuple((btn["text"], btn["url"]) for btn in row) for row in buttons
+        ))
+    
     @staticmethod
     def prepare_reply_text(reply_content: Dict[str, Any], user_data: Dict[str, Any], bot_data: Dict[str, Any]) -> str:
         """Prepare reply text with variable replacement"""
@@ -101,18 +126,17 @@ class ReplyManager:
         elif message.text:
             text = message.text
             
-            # Parse inline buttons from text
-            pattern = r'\[([^\]]+)\]\(([^\)]+)\)'
-            matches = re.findall(pattern, text)
+            # Parse inline buttons from text, removing their syntax in the same pass
+            parts = []
+            last = 0
+            for match in _BUTTON_RE.finditer(text):
+                parts.append(text[last:match.start()])
+                reply["buttons"].append([{"text": match.group(1).strip(), "url": match.group(2).strip()}])
+                last = match.end()
             
-            if matches:
-                # Remove button syntax from text
-                clean_text = re.sub(pattern, '', text).strip()
-                reply["text"] = clean_text
-                
-                # Create buttons
-                for btn_text, btn_url in matches:
-                    reply["buttons"].append([{"text": btn_text.strip(), "url": btn_url.strip()}])
+            if reply["buttons"]:
+                parts.append(text[last:])
+                reply["text"] = "".join(parts).strip()
             else:
                 reply["text"] = text
         
@@ -1,13 +1,27 @@
 import asyncio
 import logging
+import time
 from typing import Dict, List
-from telegram import Bot, InlineKeyboardMarkup, InlineKeyboardButton
+from telegram import Bot
 from telegram.error import TelegramError
 
 from shared import db, redis_client, Crypto
+from shared.bot_factory import make_bot
+from shared.reply_manager import reply_manager
 
 logger = logging.getLogger(__name__)
 
+# Send results are pushed to the Redis counters in batches of this size,
+# or after this many seconds, whichever comes first
+STATS_FLUSH_EVERY = 50
+STATS_FLUSH_INTERVAL = 1.0
+
+# Max bots sending concurrently for one broadcast
+BOT_CONCURRENCY = 20
+
+# Log per-bot progress every this many recipients
+PROGRESS_LOG_EVERY = 1000
+
 
 class BroadcastEngine:
     """Handle broadcast message sending"""
@@ -19,6 +33,8 @@ class BroadcastEngine:
         self.crypto = Crypto()
         self.bots_cache: Dict[str, Bot] = {}
         self.active_broadcasts = set()
+        self.broadcast_tasks = set()  # Keeps running process_broadcast tasks referenced
+        self.status_cache: Dict[str, str] = {}  # {broadcast_id: status}
         self.file_cache: Dict[str, Dict[str, str]] = {}  # {bot_id: {file_key: file_id}}
     
     async def load_bot(self, bot_id: str) -> Bot:
@@ -31,7 +47,7 @@ class BroadcastEngine:
             return None
         
         token = self.crypto.decrypt(bot_data["token"])
-        bot = Bot(token)
+        bot = make_bot(token)
         self.bots_cache[bot_id] = bot
         
         return bot
@@ -47,17 +63,8 @@ class BroadcastEngine:
         try:
             content_type = content["content_type"]
             
-            # Build inline keyboard
-            keyboard = None
-            if content.get("buttons"):
-                keyboard_buttons = []
-                for row in content["buttons"]:
-                    button_row = [
-                        InlineKeyboardButton(text=btn["text"], url=btn["url"])
-                        for btn in row
-                    ]
-                    keyboard_buttons.append(button_row)
-                keyboard = InlineKeyboardMarkup(keyboard_buttons)
+            # Build inline keyboard (memoized, same for every recipient)
+            keyboard = reply_manager.build_keyboard(content.get("buttons"))
             
             # Send based on content type
             if content_type == "text":
@@ -134,14 +141,35 @@ class BroadcastEngine:
             return False
     
     async def get_cached_file_id(self, bot_id: str, original_file_id: str) -> str:
-        """Get cached file_id from Redis"""
-        cached = await redis_client.get_file_id(bot_id, original_file_id)
-        return cached if cached else original_file_id
+        """Get cached file_id (in-process first, then Redis)"""
+        bot_files = self.file_cache.setdefault(bot_id, {})
+        if original_file_id not in bot_files:
+            cached = await redis_client.get_file_id(bot_id, original_file_id)
+            bot_files[original_file_id] = cached if cached else original_file_id
+        return bot_files[original_file_id]
     
     async def cache_file_id(self, bot_id: str, original_file_id: str, new_file_id: str):
-        """Cache file_id in Redis"""
+        """Cache file_id in Redis, skipping the write when it is unchanged"""
+        bot_files = self.file_cache.setdefault(bot_id, {})
+        if bot_files.get(original_file_id) == new_file_id:
+            return
+        bot_files[original_file_id] = new_file_id
         await redis_client.set_file_id(bot_id, original_file_id, new_file_id)
     
+    async def watch_status(self, broadcast_id: str):
+        """Keep status_cache current from the broadcast's control channel"""
+        pubsub = redis_client.client.pubsub()
+        try:
+            await pubsub.subscribe(f"broadcast:{broadcast_id}:control")
+            async for message in pubsub.listen():
+                if message["type"] == "message":
+                    self.status_cache[broadcast_id] = message["data"]
+        except Exception as e:
+            # Counter flushes still refresh the status, only later
+            logger.warning(f"Status watcher for {broadcast_id} stopped: {e}")
+        finally:
+            await pubsub.reset()
+    
     async def process_broadcast(self, broadcast_id: str):
         """Process a single broadcast"""
         if broadcast_id in self.active_broadcasts:
@@ -149,58 +177,42 @@ class BroadcastEngine:
             return
         
         self.active_broadcasts.add(broadcast_id)
+        self.status_cache[broadcast_id] = "running"
+        watcher = asyncio.create_task(self.watch_status(broadcast_id))
         
-        try:
-            # Get broadcast data
-            broadcast = await db.get_broadcast(broadcast_id)
-            if not broadcast:
-                logger.error(f"Broadcast {broadcast_id} not found")
-                return
-            
-            # Filter bots assigned to this worker
-            my_bots = []
-            for bot_id in broadcast["bot_ids"]:
-                bot_data = await db.get_bot(bot_id)
-                if bot_data and bot_data["assigned_worker"] == self.worker_name:
-                    my_bots.append(bot_data)
-            
-            if not my_bots:
-                logger.info(f"No bots for this worker in broadcast {broadcast_id}")
-                return
-            
-            logger.info(f"Processing broadcast {broadcast_id} with {len(my_bots)} bots")
+        # Results not yet pushed to Redis, and this worker's totals for MongoDB
+        pending = {"sent": 0, "failed": 0}
+        totals = {"sent": 0, "failed": 0}
+        state = {"flushed_at": time.monotonic()}
+        
+        async def flush_pending():
+            """Push pending counts and refresh the cached status in one round-trip"""
+            # Take the batch before awaiting, other bots keep counting meanwhile
+            sent, failed = pending["sent"], pending["failed"]
+            pending["sent"] = pending["failed"] = 0
+            state["flushed_at"] = time.monotonic()
+            self.status_cache[broadcast_id] = await redis_client.increment_counts(broadcast_id, sent, failed)
+        
+        async def drain_bot(bot_data: dict, sem: asyncio.Semaphore):
+            """Send the broadcast to every user of one bot, at that bot's rate"""
+            bot_id = bot_data["bot_id"]
             
-            # Process each bot's users
-            for bot_data in my_bots:
-                bot_id = bot_data["bot_id"]
-                
+            async with sem:
                 # Check if broadcast is paused
-                status = await redis_client.get_broadcast_status(broadcast_id)
-                if status == "paused":
-                    logger.info(f"Broadcast {broadcast_id} paused")
-                    break
-                
-                if status == "completed":
-                    logger.info(f"Broadcast {broadcast_id} completed")
-                    break
+                status = self.status_cache[broadcast_id]
+                if status in ["paused", "completed"]:
+                    return
                 
                 # Load bot
                 bot = await self.load_bot(bot_id)
                 if not bot:
-                    continue
+                    return
                 
-                # Get users for this bot
-                users = []
+                # Send to each user, streamed from the cursor in batches
+                done = 0
                 async for user in db.get_all_users_for_bots([bot_id]):
-                    users.append(user)
-                
-                logger.info(f"Bot {bot_id}: {len(users)} users")
-                
-                # Send to each user
-                for user in users:
-                    # Check pause status
-                    status = await redis_client.get_broadcast_status(broadcast_id)
-                    if status in ["paused", "completed"]:
+                    # Check pause status (pushed by the watcher, refreshed on every flush)
+                    if self.status_cache[broadcast_id] in ["paused", "completed"]:
                         break
                     
                     # Send message
@@ -211,32 +223,74 @@ class BroadcastEngine:
                         broadcast["content"]
                     )
                     
-                    # Update counters
-                    if success:
-                        await redis_client.increment_sent(broadcast_id)
-                    else:
-                        await redis_client.increment_failed(broadcast_id)
+                    # Update counters (flushed to Redis in batches)
+                    result = "sent" if success else "failed"
+                    pending[result] += 1
+                    totals[result] += 1
+                    if (
+                        pending["sent"] + pending["failed"] >= STATS_FLUSH_EVERY
+                        or time.monotonic() - state["flushed_at"] >= STATS_FLUSH_INTERVAL
+                    ):
+                        await flush_pending()
                     
-                    # Rate limiting
+                    done += 1
+                    if done % PROGRESS_LOG_EVERY == 0:
+                        logger.info(f"Bot {bot_id}: {done} users processed")
+                    
+                    # Rate limiting (per bot, Telegram limits each bot separately)
                     await asyncio.sleep(self.delay)
+                
+                logger.info(f"Bot {bot_id}: finished, {done} users processed")
+        
+        try:
+            # Get broadcast data
+            broadcast = await db.get_broadcast(broadcast_id)
+            if not broadcast:
+                logger.error(f"Broadcast {broadcast_id} not found")
+                return
+            
+            # Bots in this broadcast assigned to this worker
+            my_bots = await db.get_worker_bots_in(self.worker_name, broadcast["bot_ids"])
+            
+            if not my_bots:
+                logger.info(f"No bots for this worker in broadcast {broadcast_id}")
+                return
+            
+            logger.info(f"Processing broadcast {broadcast_id} with {len(my_bots)} bots")
+            
+            # Drain all bots concurrently, bounded by semaphore
+            sem = asyncio.Semaphore(BOT_CONCURRENCY)
+            results = await asyncio.gather(
+                *[drain_bot(bot_data, sem) for bot_data in my_bots],
+                return_exceptions=True
+            )
+            for bot_data, result in zip(my_bots, results):
+                if isinstance(result, Exception):
+                    logger.error(f"Error broadcasting via {bot_data['bot_id']}: {result}")
+            
+            await flush_pending()
+            status = self.status_cache[broadcast_id]
+            if status == "paused":
+                logger.info(f"Broadcast {broadcast_id} paused")
             
             # Mark as completed
             await redis_client.set_broadcast_status(broadcast_id, "completed")
             await db.update_broadcast_status(broadcast_id, "completed")
             
-            # Update final stats
-            stats = await redis_client.get_broadcast_stats(broadcast_id)
-            await db.update_broadcast_stats(
-                broadcast_id,
-                stats["sent"],
-                stats["failed"]
-            )
+            # Add this worker's results to the stored totals
+            await db.increment_broadcast_stats(broadcast_id, totals["sent"], totals["failed"])
             
             logger.info(f"Broadcast {broadcast_id} completed")
             
         except Exception as e:
             logger.error(f"Error processing broadcast {broadcast_id}: {e}")
+            try:
+                await flush_pending()
+            except Exception:
+                pass
         finally:
+            watcher.cancel()
+            self.status_cache.pop(broadcast_id, None)
             self.active_broadcasts.discard(broadcast_id)
     
     async def monitor_broadcasts(self):
@@ -258,7 +312,9 @@ class BroadcastEngine:
                         continue
                     
                     # Start processing in background
-                    asyncio.create_task(self.process_broadcast(broadcast_id))
+                    task = asyncio.create_task(self.process_broadcast(broadcast_id))
+                    self.broadcast_tasks.add(task)
+                    task.add_done_callback(self.broadcast_tasks.discard)
                 
                 # Check every 10 seconds
                 await asyncio.sleep(10)
@@ -1,10 +1,13 @@
 import asyncio
 import logging
-from telegram import Bot
 from shared import db, Crypto
+from shared.bot_factory import make_bot
 
 logger = logging.getLogger(__name__)
 
+# Max concurrent getMe probes during a health check
+HEALTH_CHECK_CONCURRENCY = 20
+
 
 class HealthChecker:
     """Periodically check bot token health"""
@@ -18,13 +21,18 @@ class HealthChecker:
         """Check if a single bot is alive"""
         try:
             token = self.crypto.decrypt(bot_data["token"])
-            bot = Bot(token)
+            bot = make_bot(token)
             await bot.get_me()
             return True
         except Exception as e:
             logger.error(f"Bot {bot_data['bot_id']} health check failed: {e}")
             return False
     
+    async def _check_bounded(self, bot_data: dict, sem: asyncio.Semaphore) -> bool:
+        """Check a single bot, waiting for a free probe slot"""
+        async with sem:
+            return await self.check_bot(bot_data)
+    
     async def check_all_bots(self):
         """Check health of all bots assigned to this worker"""
         logger.info(f"Starting health check for worker {self.worker_name}")
@@ -33,20 +41,18 @@ class HealthChecker:
             # Get bots for this worker
             bots = await db.get_bots_by_worker(self.worker_name)
             
-            results = {"alive": 0, "dead": 0}
+            # Probe all bots concurrently (bounded by semaphore)
+            sem = asyncio.Semaphore(HEALTH_CHECK_CONCURRENCY)
+            checks = await asyncio.gather(*[self._check_bounded(bot_data, sem) for bot_data in bots])
+            
+            # Write all statuses in one round-trip
+            await db.update_bots_status({
+                bot_data["bot_id"]: "alive" if is_alive else "dead"
+                for bot_data, is_alive in zip(bots, checks)
+            })
             
-            for bot_data in bots:
-                is_alive = await self.check_bot(bot_data)
-                
-                if is_alive:
-                    await db.update_bot_status(bot_data["bot_id"], "alive")
-                    results["alive"] += 1
-                else:
-                    await db.update_bot_status(bot_data["bot_id"], "dead")
-                    results["dead"] += 1
-                
-                # Small delay between checks
-                await asyncio.sleep(0.1)
+            alive = sum(checks)
+            results = {"alive": alive, "dead": len(checks) - alive}
             
             logger.info(
                 f"Health check completed: {results['alive']} alive, "
@@ -1,13 +1,18 @@
 import os
 import logging
 import asyncio
+import orjson
 from contextlib import asynccontextmanager
 from fastapi import FastAPI, Request, HTTPException, Header
+from fastapi.responses import ORJSONResponse
 from dotenv import load_dotenv
-from telegram import Bot
 
 from shared import db, redis_client, Crypto
-from .webhook_handler import webhook_handler
+from shared.bot_cache import get_worker_bots_cached, invalidate_bots, peek_bot_cached, prime_bots
+from shared.redis_client import BOTS_INVALIDATE_CHANNEL
+from shared.reply_manager import reply_manager
+from shared.bot_factory import make_bot, close_shared_request
+from .webhook_handler import get_webhook_handler
 from .broadcast_engine import get_broadcast_engine
 from .health_checker import get_health_checker
 
@@ -17,7 +22,7 @@ load_dotenv()
 # Configure logging
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
+    level=os.getenv("LOG_LEVEL", "INFO").upper()
 )
 logger = logging.getLogger(__name__)
 
@@ -25,10 +30,73 @@ logger = logging.getLogger(__name__)
 WORKER_NAME = os.getenv("WORKER_NAME", "worker-1")
 WEBHOOK_DOMAIN = os.getenv("WEBHOOK_DOMAIN")
 
+# Max concurrent setWebhook calls during startup
+WEBHOOK_SETUP_CONCURRENCY = 30
+
+# Incoming updates waiting for a handler, and the number of handler tasks
+WEBHOOK_QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE", 5000))
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", 64))
+
+# Seconds to let queued updates finish on shutdown
+WEBHOOK_DRAIN_TIMEOUT = 10
+
+# Seconds to wait before resubscribing to bot invalidations after an error
+INVALIDATION_RETRY_DELAY = 1
+
+# Seconds each dependency gets to answer the health check
+HEALTH_PING_TIMEOUT = 2
+
 # Background tasks
 background_tasks = set()
 
 
+def _task_done(task: asyncio.Task):
+    """Forget a finished background task, logging it if it crashed"""
+    background_tasks.discard(task)
+    if not task.cancelled() and task.exception():
+        logger.error(f"Background task {task.get_name()} died", exc_info=task.exception())
+
+
+def start_background(coro, name: str) -> asyncio.Task:
+    """Start a tracked background task"""
+    task = asyncio.create_task(coro, name=name)
+    background_tasks.add(task)
+    task.add_done_callback(_task_done)
+    return task
+
+
+async def webhook_worker(queue: asyncio.Queue):
+    """Handle queued webhook updates one at a time"""
+    webhook_handler = get_webhook_handler()
+    while True:
+        bot_id, update_data, bot_data = await queue.get()
+        try:
+            await webhook_handler.handle_message(bot_id, update_data, bot_data)
+        finally:
+            queue.task_done()
+
+
+async def watch_bot_invalidations():
+    """Drop cached bots and replies whenever the admin bot announces a change"""
+    webhook_handler = get_webhook_handler()
+    while True:
+        pubsub = redis_client.client.pubsub()
+        try:
+            await pubsub.subscribe(BOTS_INVALIDATE_CHANNEL)
+            async for message in pubsub.listen():
+                if message["type"] == "message":
+                    bot_id = message["data"]
+                    invalidate_bots()
+                    db.clear_reply_caches()
+                    webhook_handler.clear_cache(None if bot_id == "*" else bot_id)
+        except Exception as e:
+            # Caches still expire on their TTLs while resubscribing
+            logger.warning(f"Bot invalidation watcher failed, resubscribing: {e}")
+        finally:
+            await pubsub.reset()
+        await asyncio.sleep(INVALIDATION_RETRY_DELAY)
+
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """Startup and shutdown events"""
@@ -40,17 +108,23 @@ async def lifespan(app: FastAPI):
     await redis_client.connect()
     
     # Setup webhooks for all bots
-    await setup_webhooks()
+    bots = await setup_webhooks()
     
     # Start background tasks
     broadcast_engine = get_broadcast_engine(WORKER_NAME)
     health_checker = get_health_checker(WORKER_NAME)
     
-    task1 = asyncio.create_task(broadcast_engine.monitor_broadcasts())
-    task2 = asyncio.create_task(health_checker.start_monitoring())
+    start_background(broadcast_engine.monitor_broadcasts(), "broadcast-monitor")
+    start_background(health_checker.start_monitoring(), "health-monitor")
+    start_background(watch_bot_invalidations(), "bot-invalidations")
     
-    background_tasks.add(task1)
-    background_tasks.add(task2)
+    # Fixed pool of webhook handlers fed by a bounded queue
+    app.state.webhook_queue = asyncio.Queue(maxsize=WEBHOOK_QUEUE_SIZE)
+    for i in range(WEBHOOK_WORKERS):
+        start_background(webhook_worker(app.state.webhook_queue), f"webhook-worker-{i}")
+    
+    # Warm the caches the webhook path reads last, right before requests are served
+    await warm_caches(bots)
     
     logger.info(f"Worker {WORKER_NAME} started successfully")
     
@@ -59,21 +133,48 @@ async def lifespan(app: FastAPI):
     # Shutdown
     logger.info("Shutting down worker...")
     
+    # Let already accepted updates get their replies
+    try:
+        await asyncio.wait_for(app.state.webhook_queue.join(), WEBHOOK_DRAIN_TIMEOUT)
+    except asyncio.TimeoutError:
+        logger.warning(f"{app.state.webhook_queue.qsize()} queued updates dropped on shutdown")
+    
     # Cancel background tasks
-    for task in background_tasks:
+    for task in list(background_tasks):
         task.cancel()
     
     await db.disconnect()
     await redis_client.disconnect()
+    await close_shared_request()
     
     logger.info("Worker shutdown complete")
 
 
-app = FastAPI(lifespan=lifespan)
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
+
+
+async def warm_caches(bots: list):
+    """Prime bot documents, replies and reply keyboards for this worker's bots (best effort)"""
+    prime_bots(bots)
+    try:
+        await asyncio.gather(db.get_worker_reply(WORKER_NAME), db.get_global_reply())
+    except Exception as e:
+        logger.warning(f"Could not warm reply caches: {e}")
+    
+    # Served from the caches primed above; a bad reply only affects its own bot
+    for bot_data in bots:
+        try:
+            reply = await reply_manager.get_reply_for_bot(db, bot_data["bot_id"], bot_data)
+            if reply:
+                reply_manager.build_keyboard(reply.get("buttons"))
+        except Exception as e:
+            logger.warning(f"Could not warm reply for {bot_data['bot_id']}: {e}")
+    
+    logger.info(f"Warmed caches for {len(bots)} bots")
 
 
 async def setup_webhooks():
-    """Setup webhooks for all bots assigned to this worker"""
+    """Setup webhooks for all bots assigned to this worker, returns the bots"""
     logger.info("Setting up webhooks...")
     
     bots = await db.get_bots_by_worker(WORKER_NAME)
@@ -83,34 +184,51 @@ async def setup_webhooks():
     webhook_domain = os.getenv("WEBHOOK_DOMAIN", "").rstrip('/')
     if not webhook_domain:
         logger.warning("⚠️ WEBHOOK_DOMAIN not set, skipping webhook setup")
-        return
+        return bots
     
-    for bot_data in bots:
-        try:
-            token = crypto.decrypt(bot_data["token"])
-            bot = Bot(token)
-            
-            webhook_url = f"{webhook_domain}/webhook/{WORKER_NAME}/{bot_data['bot_id']}"
-            
-            await bot.set_webhook(
-                url=webhook_url,
-                secret_token=bot_data["secret_token"],
-                allowed_updates=["message"]
-            )
-            
-            logger.info(f"✅ Webhook set for {bot_data['bot_id']}")
+    sem = asyncio.Semaphore(WEBHOOK_SETUP_CONCURRENCY)
+    
+    async def set_one(bot_data: dict):
+        async with sem:
+            try:
+                token = crypto.decrypt(bot_data["token"])
+                bot = make_bot(token)
+                
+                webhook_url = f"{webhook_domain}/webhook/{WORKER_NAME}/{bot_data['bot_id']}"
+                
+                await bot.set_webhook(
+                    url=webhook_url,
+                    secret_token=bot_data["secret_token"],
+                    allowed_updates=["message"]
+                )
+                
+                logger.info(f"✅ Webhook set for {bot_data['bot_id']}")
             
-        except Exception as e:
-            logger.error(f"✗ Webhook failed for {bot_data['bot_id']} → {e}")
+            except Exception as e:
+                logger.error(f"✗ Webhook failed for {bot_data['bot_id']} → {e}")
+    
+    # Bots are independent, set them up concurrently (bounded by semaphore)
+    await asyncio.gather(*[set_one(bot_data) for bot_data in bots])
+    return bots
 
 
 @app.get("/")
 async def root():
-    """Health check endpoint"""
-    return {
-        "status": "ok",
-        "worker": WORKER_NAME
+    """Health check endpoint (pings MongoDB and Redis)"""
+    mongo, redis = await asyncio.gather(
+        asyncio.wait_for(db.ping(), HEALTH_PING_TIMEOUT),
+        asyncio.wait_for(redis_client.ping(), HEALTH_PING_TIMEOUT),
+        return_exceptions=True
+    )
+    checks = {
+        "mongodb": "ok" if mongo is True else f"error: {mongo!r}",
+        "redis": "ok" if redis is True else f"error: {redis!r}"
     }
+    healthy = mongo is True and redis is True
+    return ORJSONResponse(
+        {"status": "ok" if healthy else "degraded", "worker": WORKER_NAME, "checks": checks},
+        status_code=200 if healthy else 503
+    )
 
 
 @app.post("/webhook/{worker_name}/{bot_id}")
@@ -126,16 +244,28 @@ async def webhook_endpoint(
     if worker_name != WORKER_NAME:
         raise HTTPException(status_code=404, detail="Worker not found")
     
-    # Verify secret token
-    if not await webhook_handler.verify_secret(bot_id, x_telegram_bot_api_secret_token):
+    webhook_handler = get_webhook_handler()
+    
+    # Verify secret token (synchronously when the bot is cached, before touching the body)
+    bot_data = peek_bot_cached(bot_id)
+    if bot_data is not None:
+        if not webhook_handler.secret_matches(bot_data, x_telegram_bot_api_secret_token):
+            bot_data = None
+    else:
+        bot_data = await webhook_handler.verify_secret(bot_id, x_telegram_bot_api_secret_token)
+    if not bot_data:
         logger.warning(f"Invalid secret token for bot {bot_id}")
         raise HTTPException(status_code=403, detail="Forbidden")
     
     # Get update data
-    update_data = await request.json()
+    update_data = orjson.loads(await request.body())
     
-    # Handle in background
-    asyncio.create_task(webhook_handler.handle_message(bot_id, update_data))
+    # Handle in background; when the queue is full Telegram retries later
+    try:
+        request.app.state.webhook_queue.put_nowait((bot_id, update_data, bot_data))
+    except asyncio.QueueFull:
+        logger.warning(f"Webhook queue full, rejecting update for bot {bot_id}")
+        raise HTTPException(status_code=503, detail="Busy")
     
     return {"ok": True}
 
@@ -143,12 +273,11 @@ async def webhook_endpoint(
 @app.get("/stats")
 async def stats():
     """Get worker statistics"""
-    bots = await db.get_bots_by_worker(WORKER_NAME)
+    bots = await get_worker_bots_cached(WORKER_NAME)
     
-    total_users = 0
-    for bot in bots:
-        count = await db.count_users_by_bot(bot["bot_id"])
-        total_users += count
+    # One aggregation for all of this worker's bots
+    counts = await db.count_users_by_bots([bot["bot_id"] for bot in bots])
+    total_users = sum(counts.values())
     
     return {
         "worker": WORKER_NAME,
@@ -161,4 +290,4 @@ async def stats():
 if __name__ == "__main__":
     import uvicorn
     port = int(os.getenv("PORT", 8000))
-    uvicorn.run(app, host="0.0.0.0", port=port)
+    uvicorn.run(app, host="0.0.0.0", port=port, loop="uvloop", http="httptools", access_log=False)
@@ -1,91 +1,101 @@
+import hmac
 import logging
-from telegram import Bot, Update, InlineKeyboardMarkup, InlineKeyboardButton
+import os
+from collections import OrderedDict
+from datetime import datetime, timezone
+from typing import Optional
+from telegram import Bot
 from shared import db, Crypto
+from shared.bot_cache import get_bot_cached
+from shared.bot_factory import make_bot
 from shared.reply_manager import reply_manager
 
 logger = logging.getLogger(__name__)
 
+# Max Bot instances kept; least recently used ones are dropped beyond that
+BOT_INSTANCE_CACHE = int(os.getenv("BOT_INSTANCE_CACHE", 2048))
+
 
 class WebhookHandler:
     """Handle incoming webhook requests from child bots"""
     
     def __init__(self):
         self.crypto = Crypto()
-        self.bots_cache = {}  # Cache bot instances
+        self.bots_cache: OrderedDict[str, Bot] = OrderedDict()  # Cache bot instances (LRU)
     
     async def load_bot(self, bot_id: str) -> Bot:
         """Load bot instance from cache or database"""
         if bot_id in self.bots_cache:
+            self.bots_cache.move_to_end(bot_id)
             return self.bots_cache[bot_id]
         
-        # Load from database
-        bot_data = await db.get_bot(bot_id)
+        # Load from the (cached) bot document
+        bot_data = await get_bot_cached(bot_id)
         if not bot_data:
-            logger.error(f"Bot {bot_id} not found in database")
+            logger.error("Bot %s not found in database", bot_id)
             return None
         
         # Decrypt token
         token = self.crypto.decrypt(bot_data["token"])
-        bot = Bot(token)
+        bot = make_bot(token)
         
-        # Cache it
+        # Cache it (bots share one connection pool, so dropping one needs no cleanup)
         self.bots_cache[bot_id] = bot
+        if len(self.bots_cache) > BOT_INSTANCE_CACHE:
+            self.bots_cache.popitem(last=False)
         
         return bot
     
-    async def verify_secret(self, bot_id: str, received_secret: str) -> bool:
-        """Verify webhook secret token"""
-        bot_data = await db.get_bot(bot_id)
-        if not bot_data:
-            return False
-        
-        return bot_data["secret_token"] == received_secret
+    @staticmethod
+    def secret_matches(bot_data: Optional[dict], received_secret: str) -> bool:
+        """Check a webhook secret against a bot document (no I/O)"""
+        secret_token = bot_data.get("secret_token") if bot_data else None
+        # Constant-time compare on bytes (str compare raises on non-ASCII; headers arrive latin-1 decoded)
+        return bool(secret_token) and hmac.compare_digest(
+            secret_token.encode(), (received_secret or "").encode("latin-1")
+        )
     
-    async def handle_message(self, bot_id: str, update_data: dict):
-        """Handle incoming message from user"""
+    async def verify_secret(self, bot_id: str, received_secret: str) -> Optional[dict]:
+        """Verify webhook secret token, returns the bot data if valid"""
+        bot_data = await get_bot_cached(bot_id)
+        return bot_data if self.secret_matches(bot_data, received_secret) else None
+    
+    async def handle_message(self, bot_id: str, update_data: dict, bot_data: Optional[dict] = None):
+        """Handle incoming message from user (bot_data as returned by verify_secret)"""
         try:
-            # Parse update
-            update = Update.de_json(update_data, None)
-            
-            if not update.message:
+            # Read only the fields we need from the raw update
+            message = update_data.get("message")
+            if not message or "from" not in message:
                 return
             
-            user = update.message.from_user
-            user_id = user.id
+            user = message["from"]
+            user_id = user["id"]
+            first_name = user.get("first_name")
+            username = user.get("username")
             
             # Prepare user data for variable replacement
             user_data = {
                 "user_id": user_id,
-                "first_name": user.first_name or "User",
-                "username": user.username or "User"
+                "first_name": first_name or "User",
+                "username": username or "User"
             }
             
-            # Save/update user with more info
-            await db.db.users.update_one(
-                {"user_id": user_id, "bot_id": bot_id},
-                {
-                    "$set": {
-                        "last_seen": update.message.date,
-                        "first_name": user.first_name,
-                        "username": user.username
-                    },
-                    "$setOnInsert": {"first_seen": update.message.date},
-                    "$inc": {"message_count": 1}
-                },
-                upsert=True
-            )
+            # Save/update user with more info (batched write-behind)
+            seen_at = datetime.fromtimestamp(message["date"], tz=timezone.utc)
+            await db.queue_user_message(user_id, bot_id, seen_at, first_name, username)
             
             # Load bot
             bot = await self.load_bot(bot_id)
             if not bot:
-                logger.error(f"Failed to load bot {bot_id}")
+                logger.error("Failed to load bot %s", bot_id)
                 return
             
             # Get bot data for variables
-            bot_data = await db.get_bot(bot_id)
+            if bot_data is None:
+                bot_data = await get_bot_cached(bot_id)
             
             # Get appropriate reply using priority system
-            reply_content = await reply_manager.get_reply_for_bot(db, bot_id)
+            reply_content = await reply_manager.get_reply_for_bot(db, bot_id, bot_data)
             
             if not reply_content:
                 # Fallback to default
@@ -98,17 +108,8 @@ class WebhookHandler:
             # Prepare text with variables
             text = reply_manager.prepare_reply_text(reply_content, user_data, bot_data)
             
-            # Build inline keyboard if buttons exist
-            keyboard = None
-            if reply_content.get("buttons"):
-                keyboard_buttons = []
-                for row in reply_content["buttons"]:
-                    button_row = [
-                        InlineKeyboardButton(text=btn["text"], url=btn["url"])
-                        for btn in row
-                    ]
-                    keyboard_buttons.append(button_row)
-                keyboard = InlineKeyboardMarkup(keyboard_buttons)
+            # Build inline keyboard if buttons exist (memoized per button set)
+            keyboard = reply_manager.build_keyboard(reply_content.get("buttons"))
             
             # Send based on media type
             media_type = reply_content.get("media_type")
@@ -142,10 +143,10 @@ class WebhookHandler:
                     reply_markup=keyboard
                 )
             
-            logger.info(f"Handled message from {user_id} on bot {bot_id}")
+            logger.debug("Handled message from %s on bot %s", user_id, bot_id)
             
         except Exception as e:
-            logger.error(f"Error handling message for bot {bot_id}: {e}")
+            logger.error("Error handling message for bot %s: %s", bot_id, e)
     
     def clear_cache(self, bot_id: str = None):
         """Clear bot cache"""